@@ -17,20 +17,16 @@ To run this app:
 2. Run `streamlit run streamlit_app.py`
 """
 
-import pandas as pd
-import numpy as np
-from haversine import haversine, Unit
-from chart_studio import plotly as py
-import plotly.graph_objects as go
-import plotly.express as px
-import urllib.parse
-import requests
+import os
+
 import streamlit as st
+from metrics import request_trace, stage, write_prometheus
+from startup import read_bytes, read_text, warm_up
 
 
 ## PART 1 - Intro
 
-st.image('mvp_pipeline.png')
+st.image(read_bytes('images/final_pipeline.png'))
 
 st.write('''
 # Let us help you find your next apartment!
@@ -84,142 +80,99 @@ with st.form(key='user_info'):
         Note, you must click "Submit" to create/update the map.
     ''')
 
-    with open('mapbox_key.txt') as f:
-        mapbox_access_token = f.read().rstrip()
-
     submit_button = st.form_submit_button(label='Submit')
 
+# The form doesn't need the pipeline modules; load them in the background while the user fills it in
+warm_up(['commute', 'geocoding', 'plotly.express'])
+
+show_timings = st.sidebar.checkbox('Show timing breakdown')
+
 if submit_button:
 # PART 3 - Generate random apartment listings. This will be replaced with real listings in the actual deployment.    
-    # st.write(apt_types)
-    def generate_listings(st=1000, one=1000, two=1000): # creates a df of apartment listings and geocoords for studio, 1-br, and 2-br, each with a range of rents
-        studio_low = 1500
-        one_br_low = 1700
-        two_br_low = 2200
-
-        # The high end will be low end + $1000
-        high = 1000
-        
-        # GPS limits
-        
-        NW = 39.10243088446053, -77.45517065148175
-        NE = 39.10243088446053, -76.9218509753054
-        SE = 38.79255073884452, -76.9218509753054
-        SW = 38.79255073884452, -77.45517065148175
-        
-        lat_range = NW[0] - SW[0]
-        long_range = NE[1] - NW[1]
-        
-        studios = []
-        one_br = []
-        two_br = []
-        
-        for i in range(st):
-            rent = np.random.randint(studio_low, studio_low + high + 1)
-            rand = np.random.random()
-            lat =  SW[0] + rand*lat_range
-            rand = np.random.random()
-            long = SW[1] + rand*long_range
-            studios += [[rent, lat, long, 'studio']]
-        for i in range(one):
-            rent = np.random.randint(one_br_low, one_br_low + high + 1)
-            rand = np.random.random()
-            lat =  SW[0] + rand*lat_range
-            rand = np.random.random()
-            long = SW[1] + rand*long_range
-            one_br += [[rent, lat, long, '1_br']]
-        for i in range(two):
-            rent = np.random.randint(two_br_low, two_br_low + high + 1)
-            rand = np.random.random()
-            lat =  SW[0] + rand*lat_range
-            rand = np.random.random()
-            long = SW[1] + rand*long_range
-            two_br += [[rent, lat, long, '2_br']]
-                        
-        results = pd.DataFrame(studios + one_br + two_br, columns = ['rent', 'lat', 'long', 'type'])
-        results.to_pickle('listings')
-
-        return results
-
-    # Calculate the distances between each point in the df and the user's target location.
-
-    def dist(point, df): # input [lat, long] and it will return the distance between 'point' and each row in the df
-        df['distance'] = df.apply(lambda x: haversine((x.lat, x.long), (point[0], point[1]), unit='mi'), axis=1)
-        return df
-
-    def commute_adjusted_listings(hourly_income, work_loc, df, speed=40): # input $/hr, work location (lat, long), data, average speed
-        df = dist(work_loc, df)
-        df['commute_time_min'] = df['distance'] / speed * 60 # yields commute time in minutes 
-        df['adjusted_rent'] = df['rent'] + df['commute_time_min'] / 60 * hourly_income * 2 * 20 # distance/speed = time * income = dollar value of commute * 2 because commuting is roundtrip * 20 for 20 workdays per month
-        return df
-
-
-    def get_geocoords(address=address):
-        workplace = urllib.parse.quote(address)
-        try: url = f'https://api.mapbox.com/geocoding/v5/mapbox.places/{workplace}.json?access_token={mapbox_access_token}'
-        except IndexError:
+    with request_trace('apartments') as trace:
+        import plotly.graph_objects as go
+        import plotly.express as px
+        from commute import commute_adjusted_listings, generate_listings
+        from geocoding import get_geocoords
+        mapbox_access_token = read_text('mapbox_key.txt')
+
+        with stage('geocode'):
+            workplace = get_geocoords(address, mapbox_access_token) # cached, so repeat searches for the same address skip Mapbox
+        if workplace is None:
             st.write('Check your address again for typos. The address must be within the immediate DC/MD/VA area.')
-            return
-        session = requests.session()
-        location = session.get(url)
-        return location.json()['features'][0]['center']
-
-    workplace = get_geocoords(address)[::-1]
-    results = commute_adjusted_listings(40, workplace, generate_listings())
-
-
-    # PART 4 - Show graph of listings
-
-    # There is a bug in plotly where if you set the marker style, the color defaults to gray.
-    # https://github.com/plotly/plotly.py/issues/2485
-    # https://github.com/plotly/plotly.js/issues/2813 ('Note that the array `marker.color` and `marker.size`', are only available for *circle* symbols.')
-
-    results = results[(results.adjusted_rent <= rental_range[1]) & (results.adjusted_rent >= rental_range[0]) & (results.type.isin(apt_types))].sort_values('adjusted_rent')
-    results.adjusted_rent = results.adjusted_rent.astype('int')
-
-    st.dataframe(results.head())
-
-    px.set_mapbox_access_token(mapbox_access_token)
-    fig = px.scatter_mapbox(results, lat="lat", lon="long", hover_name="type", hover_data=["rent"],
-                            color="adjusted_rent", zoom=10, height=600)
-
-    fig.update_layout(mapbox_style="light")
-    fig.update_layout(margin={"r":0,"t":0,"l":0,"b":0})
-
-    fig.add_trace(go.Scattermapbox(
-            # name='Set location',
-            lat=[workplace[0]],
-            lon=[workplace[1]],
-            # mode='markers',
-            # marker={'size': 25, 'color': 'white' },
-            marker=go.scattermapbox.Marker(
-            size=25,
-            color='red',
-            # symbol='square',
+            st.stop()
+        workplace = workplace[::-1]
+        with stage('generate') as s:
+            listings = generate_listings()
+            s.rows_out = len(listings)
+        with stage('distance', rows_in=len(listings)):
+            results = commute_adjusted_listings(40, workplace, listings)
+
+
+        # PART 4 - Show graph of listings
+
+        # There is a bug in plotly where if you set the marker style, the color defaults to gray.
+        # https://github.com/plotly/plotly.py/issues/2485
+        # https://github.com/plotly/plotly.js/issues/2813 ('Note that the array `marker.color` and `marker.size`', are only available for *circle* symbols.')
+
+        with stage('filter', rows_in=len(results)) as s:
+            results = results[(results.adjusted_rent <= rental_range[1]) & (results.adjusted_rent >= rental_range[0]) & (results.type.isin(apt_types))].sort_values('adjusted_rent')
+            results.adjusted_rent = results.adjusted_rent.astype('int')
+            s.rows_out = len(results)
+
+        st.dataframe(results.head())
+
+        with stage('map_figure', rows_in=len(results)):
+            px.set_mapbox_access_token(mapbox_access_token)
+            fig = px.scatter_mapbox(results, lat="lat", lon="long", hover_name="type", hover_data=["rent"],
+                                    color="adjusted_rent", zoom=10, height=600)
+
+            fig.update_layout(mapbox_style="light")
+            fig.update_layout(margin={"r":0,"t":0,"l":0,"b":0})
+
+            fig.add_trace(go.Scattermapbox(
+                    # name='Set location',
+                    lat=[workplace[0]],
+                    lon=[workplace[1]],
+                    # mode='markers',
+                    # marker={'size': 25, 'color': 'white' },
+                    marker=go.scattermapbox.Marker(
+                    size=25,
+                    color='red',
+                    # symbol='square',
             
-            ),
-            marker_symbol = 'star',
-            # marker_color = 'white',
-            hoverinfo = 'none',
-            showlegend = False
-            )
+                    ),
+                    marker_symbol = 'star',
+                    # marker_color = 'white',
+                    hoverinfo = 'none',
+                    showlegend = False
+                    )
         
-        )
-    # fig.update_traces(marker_color='red', selector=dict(type='scattermapbox'))
-    # fig.show()
-    st.plotly_chart(fig)
-
-    st.write('''
-    ## Observations
-    Note how the average color of the listings becomes more yellow as distance increases from the target location (the star). This can be seen more easily by zooming out. This is because the adjusted rent increases as commuting time increases.
-
-    ## Future work
-    * Integrate an isochrone polygon into the map.
-    * Write a function that indicates if a point is within the polygon.
-    * Layer the isochrones for different commute times.
+                )
+            # fig.update_traces(marker_color='red', selector=dict(type='scattermapbox'))
+            # fig.show()
+        with stage('render_map'):
+            st.plotly_chart(fig)
+
+        st.write('''
+        ## Observations
+        Note how the average color of the listings becomes more yellow as distance increases from the target location (the star). This can be seen more easily by zooming out. This is because the adjusted rent increases as commuting time increases.
+
+        ## Future work
+        * Integrate an isochrone polygon into the map.
+        * Write a function that indicates if a point is within the polygon.
+        * Layer the isochrones for different commute times.
     
     
-    ''')
-
+        ''')
+
+    if show_timings:
+        import pandas as pd
+        with st.expander('Timing breakdown for this request', expanded=True):
+            st.dataframe(pd.DataFrame(trace.records))
+            if trace.mapbox_calls:
+                st.dataframe(pd.DataFrame(trace.mapbox_calls))
+    if os.environ.get('METRICS_FILE'):
+        write_prometheus(os.environ['METRICS_FILE'])
 
 
@@ -4,19 +4,13 @@
 # In[ ]:
 
 
-import pandas as pd
-import numpy as np
-from chart_studio import plotly as py
-from haversine import haversine, Unit, inverse_haversine
-import plotly.graph_objects as go
-import plotly.express as px
-import urllib.parse
-import requests, math, random
+import importlib, os
 import streamlit as st
-from shapely.geometry import Point
-from shapely.geometry.polygon import Polygon
-from sqlalchemy import create_engine
+from metrics import request_trace, stage, write_prometheus
+from startup import read_text, warm_up
 
+# Listing backends: address_data_sql.db by default, or copies built with `python listing_store.py build` / `python shards.py build`
+LISTING_MODULE = {'store': 'listing_store', 'shards': 'shards'}.get(os.environ.get('LISTING_BACKEND'), 'listings_db')
 
 
 ## PART 1 - Intro
@@ -32,6 +26,8 @@ Note, this version is a proof-of-concept using a combination of real and randoml
 
 # PART 2 - Get user's target location, speed, hourly wage
 
+num_commuters = st.number_input('How many people in your household commute?', min_value=1, max_value=4, value=1)
+
 st.write(
 '''
 ## Enter your workplace location in the fields below.
@@ -39,30 +35,45 @@ st.write(
 ''')
 
 with st.form(key='user_info'):
-    street = st.text_input('Street', max_chars=100, value='932 N Kenmore St')
-    city = st.text_input('City', max_chars=100, value='Arlington')
-    state = st.text_input('State', max_chars=2, value='VA')
-    zipcode = st.text_input('Zip', max_chars=5, value='22201')
+    commuters = []
+    for i in range(num_commuters):
+        if num_commuters > 1:
+            st.write(f'### Commuter {i + 1}')
+        # Only the first commuter gets the example address
+        street = st.text_input('Street', max_chars=100, value='932 N Kenmore St' if i == 0 else '', key=f'street_{i}')
+        city = st.text_input('City', max_chars=100, value='Arlington' if i == 0 else '', key=f'city_{i}')
+        state = st.text_input('State', max_chars=2, value='VA' if i == 0 else '', key=f'state_{i}')
+        zipcode = st.text_input('Zip', max_chars=5, value='22201' if i == 0 else '', key=f'zip_{i}')
+
+        address = street + ' ' + city + ' ' + state + ' ' + zipcode
+
+        st.write(
+        '''
+        ## Enter your hourly wage ($ per hour)
+        This will let us determine how much your time spent commuting is worth to you. The more time you spend commuting, the higher your effective rent will be.
+        ''')
 
-    address = street + ' ' + city + ' ' + state + ' ' + zipcode
+        hourly_income = st.number_input('Hourly wage', value=40, key=f'wage_{i}')
 
-    st.write(
-    '''
-    ## Enter your hourly wage ($ per hour)
-    This will let us determine how much your time spent commuting is worth to you. The more time you spend commuting, the higher your effective rent will be.
-    ''')
+        # st.write('''
+        # ## Enter your anticipated average commuting speed
+        # The default is 40 mph.
+        # ''')
 
-    hourly_income = st.number_input('Hourly wage', value=40)
+        # speed = st.number_input('Speed', min_value=1, max_value=70, value=40)
 
-    # st.write('''
-    # ## Enter your anticipated average commuting speed
-    # The default is 40 mph.
-    # ''')
+        mode = st.radio('How will you get to work?', ('Drive', 'Bike', 'Walk'), key=f'mode_{i}')
+        mode = mode.replace('Drive', 'driving').replace('Walk', 'walking').replace('Bike', 'cycling')
+        commuters.append({'address': address, 'hourly_income': hourly_income, 'mode': mode})
 
-    # speed = st.number_input('Speed', min_value=1, max_value=70, value=40)
+    st.write('''
+    ## Choose your commute zones
+    Smaller zones give a more precise commute estimate for each apartment.
+    ''')
 
-    mode = st.radio('How will you get to work?', ('Drive', 'Bike', 'Walk'))
-    mode = mode.replace('Drive', 'driving').replace('Walk', 'walking').replace('Bike', 'cycling')
+    zone_minutes = st.select_slider('Commute zone size (minutes)', options=[2, 5, 10], value=10)
+    max_commute = st.select_slider('Longest commute to map (minutes)', options=[40, 60], value=40)
+    contours = list(range(zone_minutes, max_commute + 1, zone_minutes))
 
     st.write('''
     ## Select your desired range of rents
@@ -78,11 +89,13 @@ with st.form(key='user_info'):
         Note, you must click "Submit" to create/update the map if you make a change to the search parameters above.
     ''')
 
-    with open('mapbox_key.txt') as f:
-        mapbox_access_token = f.read().rstrip()
-
     submit_button = st.form_submit_button(label='Submit')
 
+# The form doesn't need the pipeline modules; load them in the background while the user fills it in
+warm_up(['pipeline', LISTING_MODULE])
+
+show_timings = st.sidebar.checkbox('Show timing breakdown')
+
 if submit_button:
 # PART 3 - Generate random apartment listings. This will be replaced with real listings in the actual deployment.    
     # st.write(apt_types)
@@ -108,196 +121,100 @@ if submit_button:
 
     #     return map_data
 
-    def get_map_data():
-        engine = create_engine('sqlite:///address_data_sql.db')
-        # read in random apartment data plus real data
-
-        return pd.read_sql('SELECT * FROM address_data_sql;', engine)
-
-
-
-    def get_geocoords(address=address):
-        workplace = urllib.parse.quote(address)
-        try: url = f'https://api.mapbox.com/geocoding/v5/mapbox.places/{workplace}.json?access_token={mapbox_access_token}'
-        except IndexError:
-            st.write('Check your address again for typos. The address must be within the immediate DC/MD/VA area.')
-            return
-        session = requests.session()
-        location = session.get(url)
-        return location.json()['features'][0]['center']
-
-    workplace = get_geocoords(address)[::-1]
-
-    # PART 4 - Show graph of listings
-
-    # There is a bug in plotly where if you set the marker style, the color defaults to gray.
-    # https://github.com/plotly/plotly.py/issues/2485
-    # https://github.com/plotly/plotly.js/issues/2813 ('Note that the array `marker.color` and `marker.size`', are only available for *circle* symbols.')
-
-    results = get_map_data()
-    results = results[(results.rent <= rental_range[1]) & (results.rent >= rental_range[0]) & (results.type.isin(apt_types))]
-
-    if not len(results):
-        st.write(''' 
-        ## No listings met your search criteria
-        Consider broadening your criteria.
-        ''')
-    else:
-
-        def isochrone_layer(mode, minutes, workplace=workplace): # minutes = '10,20,30'
-            profile = f'mapbox/{mode}'
-            coordinates = str(workplace[1]) + ',' +  str(workplace[0])
-            contours_minutes = f'contours_minutes={minutes}'
-            r = requests.get(f'https://api.mapbox.com/isochrone/v1/{profile}/{coordinates}?{contours_minutes}&polygons=true&access_token={mapbox_access_token}').json()
-            length = len(minutes.split(','))
-
-            polygons = [Polygon(r['features'][i]['geometry']['coordinates'][0]) for i in range(length-1, -1, -1)] # create list in order of smallest to largest polygon
-            return polygons
-
-        # Get the isochrone data
-        ten_thirty_layer = isochrone_layer(mode, '10,20,30')
-        forty_layer = isochrone_layer(mode, '40')
-
-        # There is a bug in plotly where if you set the marker style, the color defaults to gray.
-        # https://github.com/plotly/plotly.py/issues/2485
-        # https://github.com/plotly/plotly.js/issues/2813 ('Note that the array `marker.color` and `marker.size`', are only available for *circle* symbols.')
-
-        # create list of polygons
-        polys = isochrone_layer(mode, '10,20,30') + isochrone_layer(mode, '40')    
-
-        def create_plotly_isochrones(polygons, colors, opacity=0.15): # enter list of polygons and func will output code for plotly
-            assert len(polygons) == len(colors), 'check length of inputs'
-            layers = [(polygons[i] - polygons[i-1]).__geo_interface__ for i in range(len(polygons) - 1, 0, -1)]
-            layers += [polygons[0].__geo_interface__]
-
-            layers = [{'source': layers[i], 'type': 'fill', 'color': colors[i], 'opacity': opacity} for i in range(len(layers))]
-
-            return layers
-
-                
-        def which_polygon(point, polygons): # returns bool if point in polygon. Will loop through polys from smallest to largest.
-            point = Point(point) # create point
-            point_found = False
-            for i in range(4):
-                if polygons[i].contains(point): # check if polygon contains point
-                    point_found = True
-                    break
-            if not point_found: return 4
-            else: return i    
-        
-        results['polygon'] = results.apply(lambda x: which_polygon([x.long, x.lat], polys), axis=1)
-        results['adjusted_rent'] = (results['rent'] + (results['polygon'] +1) * 10 * 2 * 20 /60 * 40).astype('int') # 10 minute increments
-
-
-        results['commute time (minutes)'] = results.apply(lambda x: '<10' if x.polygon == 0 else '10-20' if x.polygon == 1 else '20-30' if x.polygon == 2 else '30-40' if x.polygon == 3 else '>40', axis=1)
-
-# There is a bug in plotly where if you set the marker style, the color defaults to gray.
-# https://github.com/plotly/plotly.py/issues/2485
-# https://github.com/plotly/plotly.js/issues/2813 ('Note that the array `marker.color` and `marker.size`', are only available for *circle* symbols.')
-# https://stackoverflow.com/questions/59628536/option-symbol-in-scattermapbox-is-not-working
-# https://plotly.com/python/reference/scattermapbox/ Sets the marker symbol. Full list: https://www.mapbox.com/maki-icons/ Note that the array `marker.color` and `marker.size` are only available for "circle" symbols.
-
-        results.rename(columns={'polygon':'zone'}, inplace=True)
-
-        px.set_mapbox_access_token(mapbox_access_token)
-        fig = px.scatter_mapbox(results, lat="lat", lon="long", hover_name="type", hover_data=["rent", "zone", "random_real"],
-                                color="adjusted_rent", zoom=12, height=600)
-
-        fig.update_layout(mapbox_style="light")
-        fig.update_layout(margin={"r":0,"t":0,"l":0,"b":0})
-
-        fig.add_trace(go.Scattermapbox(
-                lat=[workplace[0]],
-                lon=[workplace[1]],
-                marker=go.scattermapbox.Marker(
-                size=25,
-                color='red',          
-                ),
-                marker_symbol = 'star',
-                hoverinfo = 'none',
-                showlegend = False
-                )  
-            )
-
-        fig.update_layout(
-            mapbox = {
-                'style': "light",
-                'center': { 'lon': workplace[1], 'lat': workplace[0]},
-                'zoom': 12, 'layers': create_plotly_isochrones(polys, ['blue', 'red', 'yellow', 'green'], 0.1) # enter colors from largest to smallest isochrone
-            },
-            margin = {'l':0, 'r':0, 'b':0, 't':0})
-
-        st.plotly_chart(fig) 
-
-       
-        results = results.sort_values('adjusted_rent').groupby('commute time (minutes)').head(3)
-        results.index = results.groupby('zone').cumcount() + 1
-        results.drop('zone', axis=1, inplace=True)
-        results = results.reset_index().rename(columns = {'index': 'rank', 'adjusted_rent': 'effective rent'})
-        results.drop('rank', axis=1, inplace=True)
-
-        # Reorder columns to put rents next to one another
-        results = results.reindex(columns=['rent', 'effective rent', 'lat', 'long', 'random_real', 'type', 'commute time (minutes)'])
-
-        opacity = 0.15
-        color_conv = {'red': f'rgba(255,0,0,{opacity})', 'blue': f'rgba(0,0,255,{opacity})', 'green': f'rgba(0,128,0,{opacity})', 
-                    'yellow': f'rgba(255,255,0,{opacity})', 'grey': f'rgb(240, 240, 240, {opacity})'}
-        time_conv = {'green': '<10', 'yellow': '10-20', 'red': '20-30', 'blue': '30-40', 'grey': '>40'}
-
-        s='''
-            green, yellow, red, blue, grey
+    with request_trace('isochrone') as trace:
+        from isochrones import get_isochrone_layers
+        from pipeline import LOD_MAX_POINTS, MAP_ZOOM, build_map_figure, cached_legend, cheapest_for_household, cheapest_per_zone, search_graph, zone_colors
+        get_map_data = importlib.import_module(LISTING_MODULE).get_map_data
+        mapbox_access_token = read_text('mapbox_key.txt')
+
+        # Each stage is memoized by the inputs it uses, so changing only the wage, rent range or types reuses the geocodes,
+        # isochrones, listings and zone classification from the last search
+        params = {'addresses': tuple(c['address'] for c in commuters), 'modes': tuple(c['mode'] for c in commuters),
+                  'wages': tuple(c['hourly_income'] for c in commuters), 'contours': tuple(contours),
+                  'rental_range': tuple(rental_range), 'apt_types': tuple(apt_types),
+                  'mapbox_access_token': mapbox_access_token, 'get_map_data': get_map_data}
+        session_stages = st.session_state.setdefault('search_stages', {})
+        resolved = {} # shared by this submit's runs, so each stage is resolved and timed once
+
+        workplaces = search_graph.run('workplaces', params, session_stages, resolved)
+        for i, workplace in enumerate(workplaces):
+            if workplace is None:
+                st.write(f'Check {"your address" if len(commuters) == 1 else f"the address for commuter {i + 1}"} again for typos. The address must be within the immediate DC/MD/VA area.')
+                st.stop()
+        workplace, mode = workplaces[0], commuters[0]['mode']
+
+        # PART 4 - Show graph of listings
+
+        # Get the isochrone data, one set per commuter fetched concurrently; results are cached per (mode, workplace grid cell, contours).
+        # Workplaces near a hub precomputed with `python hubs.py build` use the hub's isochrones and listing zones instead
+        hub = search_graph.run('hubs', params, session_stages, resolved)[0]
+        polys = search_graph.run('isochrones', params, session_stages, resolved)[0] # smallest to largest
+        if hub is not None:
+            rings = hub.layers
+        else:
+            rings = get_isochrone_layers(workplace, mode, contours, mapbox_access_token, zoom=MAP_ZOOM) # simplified map layers, cached with the isochrones
+
+        # Listings inside the bounding box of the outermost isochrones, classified into zones and priced for this household
+        results = search_graph.run('priced', params, session_stages, resolved)
+
+        if not len(results):
+            st.write(''' 
+            ## No listings met your search criteria
+            Consider broadening your criteria.
+            ''')
+        else:
+            zone_rgb = zone_colors(len(polys))
+            with stage('map_figure', rows_in=len(results)):
+                fig = build_map_figure(results, workplace, polys, zone_rgb, mapbox_access_token, rings=rings, other_workplaces=workplaces[1:])
+            with stage('render_map'): # Plotly serialization happens inside st.plotly_chart
+                st.plotly_chart(fig)
+            if len(results) > LOD_MAX_POINTS:
+                st.caption(f'{len(results):,} listings match, so the map groups nearby listings; marker size is the number of listings and color the median adjusted rent.')
+
+            with stage('top_k', rows_in=len(results)) as s:
+                if len(commuters) == 1:
+                    results = cheapest_per_zone(results, k=3)
+                else:
+                    results = cheapest_for_household(results, len(commuters), k=10)
+                s.rows_out = len(results)
+
+            st.plotly_chart(cached_legend(tuple(contours), tuple(zone_rgb)))
+
+            if len(commuters) == 1:
+                st.write('''
+                        ## The three cheapest apartments for each commute length
+                        ''')
+            else:
+                st.write('''
+                        ## The ten cheapest apartments for your household
+                        The shaded zones show the first commuter's commute times. Effective rent adds every commuter's commuting cost to the rent.
+                        ''')
+                    
+
+            # CSS to inject contained in a string
+            hide_table_row_index = """
+                        <style>
+                        tbody th {display:none}
+                        .blank {display:none}
+                        </style>
+                        """
+
+            # Inject CSS with Markdown
+            st.markdown(hide_table_row_index, unsafe_allow_html=True)
+
+            st.table(results)
+
+            st.write('''
+            ## Future work
+            The final version will use data scraped from a real estate listings site such as [apartments.com](https://www.apartments.com). You will see addresses in the table above instead of latitude and longitude.
             '''
-        li=s.split(',')
-        li=[l.replace('\n','') for l in li]
-        li=[l.replace(' ','') for l in li]
-
-        # import pandas as pd
-        # import plotly.graph_objects as go
-
-        df=pd.DataFrame.from_dict({'colour': li})
-        df['rgba'] = df.colour.map(color_conv)
-        df['time'] = df.colour.map(time_conv)
-
-        color_fig = go.Figure(data=[go.Table(
-        header=dict(
-            values=["Commute times (minutes)"],
-            line_color='black', fill_color='white',
-            align='center', font=dict(color='black', size=14)
-        ),
-        cells=dict(
-            values=[df.time],
-            line_color=['black'], fill_color=[df.rgba],
-            align='center', font=dict(color='black', size=11)
-        ))
-        ])
-        color_fig.update_layout(width=400, height=240, margin=dict(t=0, b=0, pad=0))
-        st.plotly_chart(color_fig)
-
-        st.write('''
-                ## The three cheapest apartments for each commute length
-                ''')
-                
-
-        # CSS to inject contained in a string
-        hide_table_row_index = """
-                    <style>
-                    tbody th {display:none}
-                    .blank {display:none}
-                    </style>
-                    """
-
-        # Inject CSS with Markdown
-        st.markdown(hide_table_row_index, unsafe_allow_html=True)
-
-        st.table(results)
-
-        st.write('''
-        ## Future work
-        The final version will use data scraped from a real estate listings site such as [apartments.com](https://www.apartments.com). You will see addresses in the table above instead of latitude and longitude.
-        '''
-        )
-
-
-
+            )
 
-            
\ No newline at end of file
+    if show_timings:
+        import pandas as pd
+        with st.expander('Timing breakdown for this request', expanded=True):
+            st.dataframe(pd.DataFrame(trace.records))
+            if trace.mapbox_calls:
+                st.dataframe(pd.DataFrame(trace.mapbox_calls))
+    if os.environ.get('METRICS_FILE'):
+        write_prometheus(os.environ['METRICS_FILE'])
@@ -0,0 +1,159 @@
+"""
+Headless batch search: the isochrone app's "three cheapest per commute band" for every workplace in a CSV.
+
+Each input row needs an address. mode, hourly_income, rent_min, rent_max and types (e.g. 'studio;1_br') are optional
+columns that override the command-line defaults for that row. Workplaces are searched in parallel on a process pool; with
+--store every worker memory-maps the same listing store, so the listings are paged in once per machine rather than once
+per worker. Results are written in input order as they complete, one row per (workplace, zone, rank), to CSV or to
+Parquet (needs pyarrow), so memory stays bounded however long the input is.
+
+    python listing_store.py build
+    python batch.py offices.csv --out cheapest.parquet --workers 8 --store listings_store
+"""
+
+import argparse, collections, functools, json, os, re, sys
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+from pipeline import search_workplace
+
+
+APT_TYPES = ['studio', '1_br', '2_br']
+
+_worker = {} # per-process search settings, set by init_worker
+
+
+def init_worker(mapbox_access_token, store, db, rate): # runs once in each pool process
+    import mapbox_client
+    if store and os.path.exists(os.path.join(store, 'manifest.json')): # a shards.py directory; shards are opened as searches reach them
+        from shards import get_map_data
+        _worker['get_map_data'] = functools.partial(get_map_data, path=store)
+    elif store:
+        from listing_store import get_map_data, open_store
+        open_store(store) # map the columns up front; the OS page cache shares them between processes
+        _worker['get_map_data'] = functools.partial(get_map_data, path=store)
+    else:
+        from listings_db import get_engine, get_map_data
+        _worker['get_map_data'] = functools.partial(get_map_data, engine=get_engine(db))
+    # The pool shares one Mapbox quota, so each process gets its slice of the rate limit
+    mapbox_client.client.limiter = mapbox_client.RateLimiter(rate, burst=max(1, int(rate)))
+    _worker['token'] = mapbox_access_token
+
+
+def error_message(e): # one line for the log; requests puts the full URL, access_token included, in its messages, so query strings are dropped
+    message = re.sub(r'\?[^\s\'")]*', '', f'{type(e).__name__}: {e}')
+    return message.replace(_worker['token'], '<token>') if _worker.get('token') else message
+
+
+def search_row(row, defaults): # returns (row number, cheapest_per_zone frame or None, error message or None)
+    params = {**defaults, **{k: v for k, v in row.items() if k in defaults and pd.notna(v) and v != ''}}
+    contours = list(range(int(params['zone_minutes']), int(params['max_commute']) + 1, int(params['zone_minutes'])))
+    types = params['types'].split(';') if isinstance(params['types'], str) else params['types']
+    if not str(row.get('address', '')).strip():
+        return row['row'], None, 'address not found'
+    try:
+        results = search_workplace(row['address'], params['mode'], contours, float(params['hourly_income']),
+                                   [int(params['rent_min']), int(params['rent_max'])], types, _worker['token'], _worker['get_map_data'])
+    except Exception as e: # one bad workplace shouldn't stop a nightly run
+        return row['row'], None, error_message(e)
+    if results is None:
+        return row['row'], None, 'address not found'
+    results.insert(0, 'rank', results.groupby('commute time (minutes)', sort=False).cumcount() + 1)
+    results.insert(0, 'address', row['address'])
+    results.insert(0, 'row', row['row'])
+    for column in ['type', 'random_real']:
+        results[column] = results[column].astype(str)
+    return row['row'], results, None
+
+
+def read_workplaces(path, chunk_size=1000): # yields input rows as dicts with their 0-based row number, reading the CSV in chunks
+    row = 0
+    for chunk in pd.read_csv(path, chunksize=chunk_size, dtype=str, keep_default_na=False):
+        for record in chunk.to_dict('records'):
+            yield {**record, 'row': row}
+            row += 1
+
+
+class ResultWriter:
+    # Appends result frames to a CSV or Parquet file as they arrive
+
+    def __init__(self, path):
+        self.path = path
+        self.parquet = path.endswith('.parquet')
+        self._writer = None
+        self._header = True
+        if not self.parquet and os.path.exists(path):
+            os.remove(path)
+
+    def write(self, df):
+        if self.parquet:
+            import pyarrow as pa, pyarrow.parquet as pq
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            if self._writer is None:
+                self._writer = pq.ParquetWriter(self.path, table.schema)
+            self._writer.write_table(table.cast(self._writer.schema))
+        else:
+            df.to_csv(self.path, mode='a', header=self._header, index=False)
+            self._header = False
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+
+
+def run_batch(path, out, mapbox_access_token, defaults, workers=4, store=None, db='address_data_sql.db', rate=10): # returns counts of workplaces, result rows, not found and failed
+    stats = {'workplaces': 0, 'rows': 0, 'not_found': 0, 'errors': 0}
+    writer = ResultWriter(out)
+    search = functools.partial(search_row, defaults=defaults)
+    with ProcessPoolExecutor(workers, initializer=init_worker, initargs=(mapbox_access_token, store, db, rate / workers)) as pool:
+        pending = collections.deque()
+
+        def drain(limit): # write finished results in input order until at most limit are pending
+            while len(pending) > limit:
+                row, results, error = pending.popleft().result()
+                stats['workplaces'] += 1
+                if error:
+                    stats['not_found' if error == 'address not found' else 'errors'] += 1
+                    print(json.dumps({'row': row, 'error': error}), file=sys.stderr)
+                elif len(results):
+                    writer.write(results)
+                    stats['rows'] += len(results)
+
+        for row in read_workplaces(path):
+            pending.append(pool.submit(search, row))
+            drain(workers * 4) # bounded look-ahead keeps every worker busy without reading the whole input
+        drain(0)
+    writer.close()
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the apartment search for every workplace in a CSV.')
+    parser.add_argument('workplaces', help='CSV with an address column and optional mode, hourly_income, rent_min, rent_max, types columns')
+    parser.add_argument('--out', default='batch_results.csv', help='.csv or .parquet')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--store', help='listing store or shards directory; reads address_data_sql.db if omitted')
+    parser.add_argument('--db', default='address_data_sql.db')
+    parser.add_argument('--rate', type=float, default=10, help='Mapbox requests per second across all workers')
+    parser.add_argument('--mode', default='driving', choices=['driving', 'cycling', 'walking'])
+    parser.add_argument('--hourly-income', type=float, default=40)
+    parser.add_argument('--rent-min', type=int, default=1500)
+    parser.add_argument('--rent-max', type=int, default=3500)
+    parser.add_argument('--types', default=';'.join(APT_TYPES), help="semicolon-separated, e.g. 'studio;1_br'")
+    parser.add_argument('--zone-minutes', type=int, default=10)
+    parser.add_argument('--max-commute', type=int, default=40)
+    parser.add_argument('--mapbox-key', default='mapbox_key.txt', help='file containing the Mapbox access token')
+    args = parser.parse_args()
+
+    with open(args.mapbox_key) as f:
+        mapbox_access_token = f.read().rstrip()
+
+    defaults = {'mode': args.mode, 'hourly_income': args.hourly_income, 'rent_min': args.rent_min, 'rent_max': args.rent_max,
+                'types': args.types, 'zone_minutes': args.zone_minutes, 'max_commute': args.max_commute}
+    stats = run_batch(args.workplaces, args.out, mapbox_access_token, defaults, args.workers, args.store, args.db, args.rate)
+    print(json.dumps(stats))
+
+
+if __name__ == '__main__':
+    main()
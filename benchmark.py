@@ -0,0 +1,179 @@
+"""
+Benchmark the apartment search pipeline stage by stage on synthetic listings.
+
+Listings come from a seeded generate_map_data (the notebook's generator, vectorized), and geocoding/isochrone calls go to
+a local MapboxStub, so runs need no network or access token and are repeatable. Each stage reports its best wall time
+over --repeat runs, its peak traced memory and its row counts. Results are written as JSON and can be compared against a
+saved baseline; the exit status is 1 if any stage regressed.
+
+    python benchmark.py --sizes 10000 100000 1000000 --save-baseline
+    python benchmark.py --sizes 10000 100000 1000000 --baseline benchmark_baseline.json
+
+The stub answers with synthetic isochrones unless --fixtures points at recorded responses, which --record can capture
+from the real API once (needs mapbox_key.txt).
+"""
+
+import argparse, json, os, platform, sys, tempfile, time, tracemalloc
+
+import pandas as pd
+
+from cache import TieredCache
+from commute import commute_adjusted_listings, generate_map_data
+from geocoding import get_geocoords, normalize_address
+from isochrones import ISOCHRONE_PATH, get_isochrones, snap_to_grid
+from listing_store import ListingStore, build_store
+from listings_db import TABLE, ensure_spatial_index, get_engine, get_map_data
+from mapbox_client import MapboxClient
+from mapbox_stub import MapboxStub
+from pipeline import build_map_figure, cheapest_per_zone, household_commute_matrix, search_graph, zone_colors
+
+
+ADDRESS = '932 N Kenmore St Arlington VA 22201'
+CONTOURS = [10, 20, 30, 40]
+RENTAL_RANGE = [1500, 3500]
+APT_TYPES = ['studio', '1_br', '2_br']
+NOISE_FLOOR = 0.005 # seconds; slower stages below this are not reported as regressions
+
+
+def measure(fn, repeat): # returns (result, best seconds, peak traced MB); memory is measured on a separate run so tracing doesn't skew the timings
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, best, peak / 2**20
+
+
+def run_size(n, stub, workdir, repeat, skip=(), seed=0): # runs every stage for n synthetic listings, returns {stage: stats}
+    client = MapboxClient(base_url=stub.url, rate=1000, burst=1000)
+    stats = {}
+
+    def stage(name, fn, rows_in=None, rows_out=None, needed=True): # skipped stages still run (untimed) when later stages need their result
+        if name in skip:
+            return fn() if needed else None
+        result, seconds, peak_mb = measure(fn, repeat)
+        stats[name] = {'seconds': round(seconds, 6), 'peak_mb': round(peak_mb, 3), 'rows_in': rows_in,
+                       'rows_out': rows_out(result) if rows_out else rows_in}
+        return result
+
+    # Network stages run against the stub with caching disabled, so they measure client + parsing overhead
+    center = get_geocoords(ADDRESS, 'stub', cache=TieredCache(None), client=client)
+    workplace = center[::-1]
+    stage('geocode', lambda: get_geocoords(ADDRESS, 'stub', cache=TieredCache(None), client=client), needed=False)
+    polys = stage('isochrones', lambda: get_isochrones(workplace, 'driving', CONTOURS, 'stub', cache=TieredCache(None), client=client))
+    bbox = polys[-1].bounds
+
+    # Setup (untimed): the same listings as a SQLite table and as a columnar store
+    listings = generate_map_data(workplace, 25, n, seed=seed)
+    engine = get_engine(os.path.join(workdir, f'listings_{n}.db'))
+    listings.assign(type=listings['type'].astype(str), random_real=listings['random_real'].astype(str)) \
+        .to_sql(TABLE, engine, index=False, if_exists='replace', chunksize=100_000)
+    ensure_spatial_index(engine)
+    store_path = os.path.join(workdir, f'store_{n}')
+    build_store(listings, store_path)
+
+    results = stage('load_sqlite', lambda: get_map_data(RENTAL_RANGE, APT_TYPES, bbox=bbox, engine=engine), n, len)
+    stage('load_store', lambda: ListingStore(store_path).query(RENTAL_RANGE, APT_TYPES, bbox), n, len, needed=False)
+
+    # The isochrone app's submit path: every listing in the bounding box, the zone/commute matrix, then the rent and type
+    # filters and pricing in search_graph's 'priced' stage
+    area = stage('load_area', lambda: get_map_data(None, None, bbox=bbox, engine=engine), n, len)
+    matrix = stage('commute_matrix', lambda: household_commute_matrix(area, [{'workplace': workplace, 'polys': polys}], CONTOURS),
+                   len(area), lambda m: m[0].shape[1])
+    price = search_graph.stages['priced'][0]
+    priced = stage('priced', lambda: price(area, matrix, (40,), RENTAL_RANGE, APT_TYPES, CONTOURS), len(area), len)
+    stage('top_k', lambda: cheapest_per_zone(priced), len(priced), len, needed=False)
+
+    zone_rgb = zone_colors(len(polys))
+    payload = stage('figure', lambda: build_map_figure(priced, workplace, polys, zone_rgb, 'stub').to_json(), len(priced), needed=False)
+    if payload is not None:
+        stats['figure']['payload_mb'] = round(len(payload) / 2**20, 3)
+
+    # apartments_streamlit.py path: straight-line distance pricing over every listing
+    stage('distance', lambda: commute_adjusted_listings(40, workplace, listings[['lat', 'long', 'rent']].copy()), n, needed=False)
+
+    engine.dispose()
+    return stats
+
+
+def compare(current, baseline, threshold): # returns a list of (size, stage, baseline s, current s) that got slower than threshold x baseline
+    regressions = []
+    for size, stages in current['results'].items():
+        for name, stat in stages.items():
+            base = baseline['results'].get(size, {}).get(name)
+            if base and stat['seconds'] > base['seconds'] * threshold and stat['seconds'] - base['seconds'] > NOISE_FLOOR:
+                regressions.append((size, name, base['seconds'], stat['seconds']))
+    return regressions
+
+
+def record_fixtures(path, mapbox_access_token, address=ADDRESS, modes=('driving', 'cycling', 'walking')): # saves real Mapbox responses in the MapboxStub fixture format
+    client = MapboxClient()
+    center = get_geocoords(address, mapbox_access_token, cache=TieredCache(None), client=client)
+    workplace = snap_to_grid(center[::-1], 0.001)
+    fixtures = {'geocode': {normalize_address(address): center}, 'isochrone': {}}
+    for mode in modes:
+        coordinates = f'{workplace[1]},{workplace[0]}'
+        params = {'contours_minutes': ','.join(map(str, CONTOURS)), 'polygons': 'true', 'access_token': mapbox_access_token}
+        fixtures['isochrone'][f'{mode}:{coordinates}'] = client.get_json(ISOCHRONE_PATH.format(mode=mode, long=workplace[1], lat=workplace[0]), params)['features']
+    with open(path, 'w') as f:
+        json.dump(fixtures, f)
+
+
+def print_table(results):
+    rows = [{'size': size, 'stage': name, **stat} for size, stages in results['results'].items() for name, stat in stages.items()]
+    print(pd.DataFrame(rows).to_string(index=False))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Per-stage benchmark of the apartment search pipeline.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10_000, 100_000, 1_000_000])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--skip', nargs='*', default=[], help='stage names to leave out, e.g. figure at 10M rows')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', default='benchmark_results.json')
+    parser.add_argument('--baseline', help='compare against this results file')
+    parser.add_argument('--save-baseline', action='store_true', help='also write the results to benchmark_baseline.json')
+    parser.add_argument('--threshold', type=float, default=1.25, help='slowdown ratio that counts as a regression')
+    parser.add_argument('--fixtures', help='recorded Mapbox responses for the stub')
+    parser.add_argument('--record', help='record real Mapbox responses to this fixture file and exit')
+    args = parser.parse_args()
+
+    if args.record:
+        with open('mapbox_key.txt') as f:
+            record_fixtures(args.record, f.read().rstrip())
+        return
+
+    fixtures = None
+    if args.fixtures:
+        with open(args.fixtures) as f:
+            fixtures = json.load(f)
+
+    results = {'meta': {'python': platform.python_version(), 'platform': platform.platform(), 'repeat': args.repeat, 'seed': args.seed},
+               'results': {}}
+    with MapboxStub(fixtures) as stub, tempfile.TemporaryDirectory() as workdir:
+        for n in args.sizes:
+            results['results'][str(n)] = run_size(n, stub, workdir, args.repeat, set(args.skip), args.seed)
+
+    print_table(results)
+    with open(args.out, 'w') as f:
+        json.dump(results, f, indent=2)
+    if args.save_baseline:
+        with open('benchmark_baseline.json', 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        for size, name, base, current in regressions:
+            print(f'REGRESSION {name} @ {size} rows: {base:.4f}s -> {current:.4f}s')
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+import json, sqlite3, threading, time
+from collections import OrderedDict
+
+from metrics import record_cache_lookup
+
+
+class TieredCache:
+    # In-process LRU in front of an on-disk SQLite store of JSON values. Entries older than ttl seconds are refetched.
+    # Concurrent lookups for the same key wait on one in-flight fetch instead of each calling Mapbox.
+
+    def __init__(self, path, ttl=30 * 24 * 3600, max_memory=1024, max_disk=100_000, name=None):
+        self.path = path
+        self.name = name or path or 'memory'
+        self.ttl = ttl
+        self.max_memory = max_memory
+        self.max_disk = max_disk
+        self.stats = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'coalesced': 0}
+
+        self._memory = OrderedDict() # key -> (fetched_at, value)
+        self._lock = threading.Lock()
+        self._in_flight = {} # key -> threading.Event set when the leader's fetch finishes
+
+        if path:
+            self._execute('CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value TEXT, fetched_at REAL)')
+            self._execute('CREATE INDEX IF NOT EXISTS ix_entries_fetched_at ON entries (fetched_at)')
+
+    def _execute(self, sql, params=()): # one short-lived connection per statement so the cache can be shared across threads
+        conn = sqlite3.connect(self.path, timeout=10)
+        try:
+            with conn:
+                return conn.execute(sql, params).fetchone()
+        finally:
+            conn.close()
+
+    def _count(self, result): # call with self._lock held
+        self.stats[result] += 1
+        record_cache_lookup(self.name, result)
+
+    def _fresh(self, fetched_at):
+        return time.time() - fetched_at < self.ttl
+
+    def _remember(self, key, fetched_at, value): # call with self._lock held
+        self._memory[key] = (fetched_at, value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory:
+            self._memory.popitem(last=False)
+
+    def _lookup(self, key): # memory first, then disk; returns None on a miss
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry and self._fresh(entry[0]):
+                self._memory.move_to_end(key)
+                self._count('memory_hits')
+                return entry[1]
+
+        if self.path:
+            row = self._execute('SELECT value, fetched_at FROM entries WHERE key = ?', (key,))
+            if row and self._fresh(row[1]):
+                value = json.loads(row[0])
+                with self._lock:
+                    self._remember(key, row[1], value)
+                    self._count('disk_hits')
+                return value
+        return None
+
+    def fetched_at(self, key): # when the in-memory entry for key was fetched, None if it isn't in memory
+        with self._lock:
+            entry = self._memory.get(key)
+            return entry[0] if entry else None
+
+    def _store(self, key, value):
+        fetched_at = time.time()
+        with self._lock:
+            self._remember(key, fetched_at, value)
+        if self.path:
+            self._execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?)', (key, json.dumps(value), fetched_at))
+            # Evict the oldest rows once the store grows past max_disk
+            self._execute('DELETE FROM entries WHERE key IN (SELECT key FROM entries ORDER BY fetched_at DESC LIMIT -1 OFFSET ?)', (self.max_disk,))
+
+    def get(self, key, fetch): # fetch() is only called on a miss, and only once per key across concurrent callers
+        while True:
+            value = self._lookup(key)
+            if value is not None:
+                return value
+
+            with self._lock:
+                event = self._in_flight.get(key)
+                leader = event is None
+                if leader:
+                    event = self._in_flight[key] = threading.Event()
+                else:
+                    self._count('coalesced')
+
+            if not leader:
+                event.wait()
+                continue # the leader stored the result (or failed, in which case this caller retries the fetch)
+
+            try:
+                with self._lock:
+                    self._count('misses')
+                value = fetch()
+                if value is not None:
+                    self._store(key, value)
+                return value
+            finally:
+                with self._lock:
+                    del self._in_flight[key]
+                event.set()
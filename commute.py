@@ -0,0 +1,76 @@
+import numpy as np
+import pandas as pd
+from haversine import Unit
+from haversine.haversine import get_avg_earth_radius
+
+
+EARTH_RADIUS_MI = get_avg_earth_radius(Unit.MILES) # same radius the haversine package uses, so results match haversine(..., unit='mi')
+
+# GPS limits of the area generate_listings samples from
+NW = 39.10243088446053, -77.45517065148175
+NE = 39.10243088446053, -76.9218509753054
+SE = 38.79255073884452, -76.9218509753054
+SW = 38.79255073884452, -77.45517065148175
+
+
+def haversine_miles(lat, long, point, dtype='float64'): # great-circle distance in miles from each (lat, long) to point = (lat, long); dtype='float32' halves memory for very large arrays
+    lat1 = np.radians(np.asarray(lat, dtype=dtype))
+    lng1 = np.radians(np.asarray(long, dtype=dtype))
+    lat2, lng2 = np.radians(np.asarray(point, dtype=dtype))
+
+    d = np.sin((lat2 - lat1) * 0.5) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) * 0.5) ** 2
+    return 2 * np.asarray(EARTH_RADIUS_MI, dtype=dtype) * np.arcsin(np.sqrt(d))
+
+
+def generate_listings(st=1000, one=1000, two=1000, seed=None): # creates a df of apartment listings and geocoords for studio, 1-br, and 2-br, each with a range of rents
+    rng = np.random.default_rng(seed)
+    counts = [st, one, two]
+    lows = np.repeat([1500, 1700, 2200], counts) # studio, 1-br and 2-br low ends
+    high = 1000 # the high end will be low end + $1000
+    n = sum(counts)
+
+    lat_range = NW[0] - SW[0]
+    long_range = NE[1] - NW[1]
+
+    return pd.DataFrame({
+        'rent': rng.integers(lows, lows + high + 1),
+        'lat': SW[0] + rng.random(n) * lat_range,
+        'long': SW[1] + rng.random(n) * long_range,
+        'type': pd.Categorical.from_codes(np.repeat([0, 1, 2], counts), categories=['studio', '1_br', '2_br']),
+    })
+
+
+def generate_map_data(workplace, distance, num_points=5000, seed=None): # vectorized, seedable version of the notebook's generator: listings uniformly spread within `distance` miles of workplace
+    rng = np.random.default_rng(seed)
+    lat1, lng1 = np.radians(workplace)
+    d = distance * np.sqrt(rng.random(num_points)) / EARTH_RADIUS_MI # sqrt keeps the points uniform over the disc's area
+    direction = rng.random(num_points) * 2 * np.pi
+
+    lat2 = np.arcsin(np.sin(lat1) * np.cos(d) + np.cos(lat1) * np.sin(d) * np.cos(direction))
+    lng2 = lng1 + np.arctan2(np.sin(direction) * np.sin(d) * np.cos(lat1), np.cos(d) - np.sin(lat1) * np.sin(lat2))
+
+    codes = rng.integers(0, 3, num_points)
+    lows = np.array([1500, 1700, 2200])[codes] # studio, 1-br and 2-br low ends; the high end is low end + $1000
+    return pd.DataFrame({
+        'lat': np.degrees(lat2),
+        'long': np.degrees(lng2),
+        'type': pd.Categorical.from_codes(codes, categories=['studio', '1_br', '2_br']),
+        'rent': rng.integers(lows, lows + 1000 + 1),
+        'random_real': pd.Categorical.from_codes(np.zeros(num_points, dtype='int8'), categories=['random']),
+    })
+
+
+def dist(point, df, dtype='float64'): # input [lat, long] and it will return the distance between 'point' and each row in the df
+    df['distance'] = haversine_miles(df['lat'].to_numpy(), df['long'].to_numpy(), point, dtype=dtype)
+    return df
+
+
+def commute_adjusted_listings(hourly_income, work_loc, df, speed=40, dtype='float64'): # input $/hr, work location (lat, long), data, average speed
+    df = dist(work_loc, df, dtype=dtype)
+    df['commute_time_min'] = df['distance'] / speed * 60 # yields commute time in minutes
+    df['adjusted_rent'] = df['rent'] + monthly_commute_cost(df['commute_time_min'], hourly_income) # distance/speed = time * income = dollar value of commute
+    return df
+
+
+def monthly_commute_cost(commute_minutes, hourly_income): # one-way commute minutes -> dollars per month: * 2 because commuting is roundtrip * 20 for 20 workdays per month
+    return commute_minutes / 60 * hourly_income * 2 * 20
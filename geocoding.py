@@ -0,0 +1,33 @@
+import re, urllib.parse
+
+from cache import TieredCache
+from mapbox_client import client as mapbox_client
+
+
+GEOCODE_PATH = '/geocoding/v5/mapbox.places/{address}.json'
+
+
+def normalize_address(address): # '932 N Kenmore St,  Arlington VA' and '932 n kenmore st arlington va' share one cache entry
+    address = re.sub(r'[,.#]', ' ', address.lower())
+    return ' '.join(address.split())
+
+
+geocode_cache = TieredCache('geocode_cache.db', name='geocode')
+
+
+def fetch_geocoords(address, mapbox_access_token, client=mapbox_client): # returns [long, lat] of the best match, or None if Mapbox found nothing
+    path = GEOCODE_PATH.format(address=urllib.parse.quote(address, safe=''))
+    features = client.get_json(path, {'access_token': mapbox_access_token}).get('features', [])
+    if not features:
+        return None
+    return features[0]['center']
+
+
+def get_geocoords(address, mapbox_access_token, cache=geocode_cache, client=mapbox_client): # [long, lat], or None if Mapbox found nothing
+    if not normalize_address(address): # e.g. a household member's address fields left empty: nothing to look up or cache
+        return None
+    return cache.get(client.cache_prefix + normalize_address(address), lambda: fetch_geocoords(address, mapbox_access_token, client))
+
+
+def get_geocoords_many(addresses, mapbox_access_token, cache=geocode_cache, client=mapbox_client): # geocodes a batch concurrently; the client's rate limiter keeps it within quota
+    return client.map(lambda address: get_geocoords(address, mapbox_access_token, cache, client), addresses)
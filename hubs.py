@@ -0,0 +1,249 @@
+"""
+Precomputed commute zones for popular workplace hubs (downtown offices, campuses, stations).
+
+For every hub in a CSV (name plus lat/long or an address, and optionally a semicolon-separated modes column) and every
+--contours set, `build` fetches the hub's isochrones once and stores each listing location's zone and commute estimate
+in hub_zones.db, keyed by (hub, mode, contours) and by the listing's coordinates rounded to 1e-5 degrees. Locations are
+shared by every listing in a building and don't depend on the listing backend's row ids. A search whose geocoded
+workplace is within HUB_TOLERANCE_M of a hub with the same mode and contours uses the hub's isochrones and stored zones
+instead of fetching and classifying; listings the job hasn't seen yet are classified against the hub's isochrones.
+
+Rerunning `build` is incremental: it adds locations that have appeared in the hub's area since the last run and drops
+ones that no longer have a listing, and recomputes a hub from scratch only when its isochrones have changed.
+
+    python hubs.py build hubs.csv --contours 10,20,30,40 --contours 5,10,15,20,25,30,35,40
+    python hubs.py list
+"""
+
+import argparse, functools, json, os, sqlite3, threading, time
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+from shapely.geometry.polygon import Polygon
+
+from zones import classify_nested_zones, interpolate_commute_minutes
+
+
+HUB_ZONES_PATH = os.environ.get('HUB_ZONES', 'hub_zones.db')
+HUB_TOLERANCE_M = 200 # a workplace this close to a hub uses the hub's precomputed zones
+LOCATION_PRECISION = 5 # decimal places of the coordinates listings are keyed by (about a meter)
+M_PER_DEGREE_LAT = 110_574
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS hubs (
+    id INTEGER PRIMARY KEY, name TEXT NOT NULL, mode TEXT NOT NULL, contours TEXT NOT NULL,
+    lat REAL NOT NULL, long REAL NOT NULL, rings TEXT NOT NULL, layers TEXT NOT NULL, updated_at REAL NOT NULL,
+    UNIQUE (name, mode, contours));
+CREATE TABLE IF NOT EXISTS hub_zones (
+    hub_id INTEGER NOT NULL, location INTEGER NOT NULL, zone INTEGER NOT NULL, commute_s INTEGER NOT NULL,
+    PRIMARY KEY (hub_id, location)) WITHOUT ROWID;
+'''
+
+
+def location_keys(lat, long): # one int64 per (lat, long) rounded to LOCATION_PRECISION decimals
+    scale = 10 ** LOCATION_PRECISION
+    lat = np.round(np.asarray(lat, dtype='float64') * scale).astype('int64') + 90 * scale
+    long = np.round(np.asarray(long, dtype='float64') * scale).astype('int64') + 180 * scale
+    return lat * (360 * scale + 1) + long
+
+
+def connect(path=HUB_ZONES_PATH):
+    conn = sqlite3.connect(path)
+    conn.executescript(SCHEMA)
+    return conn
+
+
+class Hub:
+    # One precomputed (hub, mode, contours) entry. Its isochrones and map layers stand in for the Mapbox fetch, and
+    # commute() looks up the stored zones instead of classifying
+
+    def __init__(self, table, row):
+        self.table = table
+        self.id, self.name, self.mode, contours, lat, long, rings, layers, self.updated_at = row
+        self.contours = tuple(int(m) for m in contours.split(','))
+        self.workplace = (lat, long)
+        self.polys = [Polygon(ring) for ring in json.loads(rings)]
+        self.layers = json.loads(layers)
+
+    def __repr__(self):
+        return f'Hub({self.name!r}, {self.mode!r}, {self.contours})'
+
+    def commute(self, lat, long): # (zones, minutes) for listings at (lat, long), like one row of pipeline.household_commute_matrix
+        keys, stored_zones, stored_seconds = self.table.zone_arrays(self)
+        wanted = location_keys(lat, long)
+        idx = np.minimum(np.searchsorted(keys, wanted), max(len(keys) - 1, 0))
+        hit = keys[idx] == wanted if len(keys) else np.zeros(len(wanted), dtype=bool)
+        zones = np.empty(len(wanted), dtype='int64')
+        minutes = np.empty(len(wanted))
+        zones[hit] = stored_zones[idx[hit]]
+        minutes[hit] = stored_seconds[idx[hit]] / 60
+        miss = np.flatnonzero(~hit)
+        if len(miss): # listings added since the last build
+            lat, long = np.asarray(lat, dtype='float64')[miss], np.asarray(long, dtype='float64')[miss]
+            zones[miss] = classify_nested_zones(lat, long, self.polys)
+            minutes[miss] = interpolate_commute_minutes(lat, long, zones[miss], self.polys, list(self.contours), self.workplace)
+        return zones, minutes
+
+
+class HubTable:
+    # The hubs in a hub_zones.db, reread whenever the file changes, plus an LRU of the zone arrays of recently used hubs
+
+    def __init__(self, path=HUB_ZONES_PATH, max_open=8):
+        self.path = path
+        self.max_open = max_open
+        self.hubs = []
+        self._mtime = None
+        self._zones = OrderedDict() # (hub id, updated_at) -> (sorted location keys, zones, commute seconds)
+        self._lock = threading.Lock()
+
+    def _read(self, sql, params=()): # one short-lived read-only connection per query, like TieredCache
+        conn = sqlite3.connect(f'file:{self.path}?mode=ro', uri=True, timeout=10)
+        try:
+            return conn.execute(sql, params).fetchall()
+        finally:
+            conn.close()
+
+    def _refresh(self): # call with self._lock held
+        mtime = os.stat(self.path).st_mtime_ns if os.path.exists(self.path) else None
+        if mtime != self._mtime:
+            self._mtime = mtime
+            if mtime is None:
+                self.hubs = []
+            else:
+                self.hubs = [Hub(self, row) for row in self._read('SELECT id, name, mode, contours, lat, long, rings, layers, updated_at FROM hubs')]
+
+    def find(self, workplace, mode, contours, tolerance_m=HUB_TOLERANCE_M): # the nearest hub within tolerance_m of workplace = (lat, long) with this mode and contours, or None
+        with self._lock:
+            self._refresh()
+            hubs = [hub for hub in self.hubs if hub.mode == mode and hub.contours == tuple(sorted(contours))]
+        best, best_m = None, tolerance_m
+        for hub in hubs:
+            dy = (hub.workplace[0] - workplace[0]) * M_PER_DEGREE_LAT
+            dx = (hub.workplace[1] - workplace[1]) * M_PER_DEGREE_LAT * np.cos(np.radians(workplace[0]))
+            if np.hypot(dx, dy) <= best_m:
+                best, best_m = hub, np.hypot(dx, dy)
+        return best
+
+    def zone_arrays(self, hub):
+        key = (hub.id, hub.updated_at)
+        with self._lock:
+            if key not in self._zones:
+                rows = self._read('SELECT location, zone, commute_s FROM hub_zones WHERE hub_id = ? ORDER BY location', (hub.id,))
+                columns = np.array(rows, dtype='int64').reshape(-1, 3)
+                self._zones[key] = (columns[:, 0], columns[:, 1], columns[:, 2].astype('float64'))
+                while len(self._zones) > self.max_open:
+                    self._zones.popitem(last=False)
+            self._zones.move_to_end(key)
+            return self._zones[key]
+
+
+@functools.lru_cache(maxsize=None)
+def open_hubs(path=HUB_ZONES_PATH): # one HubTable per path per process; it rereads the hubs itself after a build
+    return HubTable(path)
+
+
+def find_hub(workplace, mode, contours, path=HUB_ZONES_PATH): # open_hubs(path).find, or None when there is no hub table
+    if workplace is None or not os.path.exists(path):
+        return None
+    return open_hubs(path).find(workplace, mode, contours)
+
+
+def build_hub(conn, name, workplace, mode, contours, mapbox_access_token, get_map_data, full=False): # creates or incrementally updates one hub; returns counts of added and removed locations
+    from isochrones import get_isochrones, map_tolerance, ring_geometries
+    from pipeline import MAP_ZOOM
+
+    contours = sorted(contours)
+    polys = get_isochrones(workplace, mode, contours, mapbox_access_token, grid=0)
+    rings = json.dumps([[list(xy) for xy in p.exterior.coords] for p in polys])
+    contours_text = ','.join(map(str, contours))
+    row = conn.execute('SELECT id, lat, long, rings FROM hubs WHERE name = ? AND mode = ? AND contours = ?', (name, mode, contours_text)).fetchone()
+    if row is None:
+        hub_id = conn.execute('INSERT INTO hubs (name, mode, contours, lat, long, rings, layers, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                              (name, mode, contours_text, workplace[0], workplace[1], rings, '[]', 0)).lastrowid
+    else:
+        hub_id = row[0]
+        if full or row[1:] != (workplace[0], workplace[1], rings): # moved hub or new isochrones: every stored zone may be wrong
+            conn.execute('DELETE FROM hub_zones WHERE hub_id = ?', (hub_id,))
+
+    # Every distinct listing location in the area a search from the hub would load
+    listings = get_map_data(None, None, bbox=polys[-1].bounds)
+    keys, first = np.unique(location_keys(listings['lat'].to_numpy(), listings['long'].to_numpy()), return_index=True)
+    stored = np.array([r[0] for r in conn.execute('SELECT location FROM hub_zones WHERE hub_id = ?', (hub_id,))], dtype='int64')
+    new = ~np.isin(keys, stored)
+    gone = stored[~np.isin(stored, keys)]
+
+    lat = listings['lat'].to_numpy(dtype='float64')[first[new]]
+    long = listings['long'].to_numpy(dtype='float64')[first[new]]
+    zones = classify_nested_zones(lat, long, polys)
+    seconds = np.round(interpolate_commute_minutes(lat, long, zones, polys, contours, workplace) * 60).astype('int64')
+    conn.executemany('DELETE FROM hub_zones WHERE hub_id = ? AND location = ?', [(hub_id, int(k)) for k in gone])
+    conn.executemany('INSERT INTO hub_zones (hub_id, location, zone, commute_s) VALUES (?, ?, ?, ?)',
+                     zip([hub_id] * len(zones), keys[new].tolist(), zones.tolist(), seconds.tolist()))
+
+    layers = json.dumps(ring_geometries(polys, map_tolerance(MAP_ZOOM)))
+    conn.execute('UPDATE hubs SET lat = ?, long = ?, rings = ?, layers = ?, updated_at = ? WHERE id = ?', (workplace[0], workplace[1], rings, layers, time.time(), hub_id))
+    conn.commit()
+    return int(new.sum()), len(gone)
+
+
+def read_hubs(path, mapbox_access_token, default_modes=('driving',)): # [(name, (lat, long), modes)] from a CSV with name and either lat/long or address columns
+    from geocoding import get_geocoords
+    hubs = []
+    for row in pd.read_csv(path).to_dict('records'):
+        if 'lat' in row and pd.notna(row['lat']):
+            workplace = (float(row['lat']), float(row['long']))
+        else:
+            center = get_geocoords(row['address'], mapbox_access_token)
+            if center is None:
+                print(f"{row['name']}: address not found, skipped")
+                continue
+            workplace = tuple(center[::-1])
+        modes = str(row['modes']).split(';') if 'modes' in row and pd.notna(row['modes']) else list(default_modes)
+        hubs.append((row['name'], workplace, modes))
+    return hubs
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Precompute commute zones for popular workplace hubs.')
+    parser.add_argument('command', choices=['build', 'list'])
+    parser.add_argument('hubs', nargs='?', help='CSV with name and lat/long or address columns, and optional modes (build only)')
+    parser.add_argument('--out', default=HUB_ZONES_PATH)
+    parser.add_argument('--contours', action='append', help='comma-separated minutes; repeat for several zone sizes (default 10,20,30,40)')
+    parser.add_argument('--mode', action='append', choices=['driving', 'cycling', 'walking'], help='modes for hubs without a modes column (default driving)')
+    parser.add_argument('--store', help='listing store or shards directory; reads address_data_sql.db if omitted')
+    parser.add_argument('--db', default='address_data_sql.db')
+    parser.add_argument('--mapbox-key', default='mapbox_key.txt', help='file containing the Mapbox access token')
+    parser.add_argument('--full', action='store_true', help='recompute every stored zone instead of updating incrementally')
+    args = parser.parse_args()
+
+    conn = connect(args.out)
+    if args.command == 'list':
+        for name, mode, contours, count in conn.execute('SELECT name, mode, contours, (SELECT COUNT(*) FROM hub_zones WHERE hub_id = id) FROM hubs ORDER BY name, mode, contours'):
+            print(f'{name} {mode} [{contours}]: {count} locations')
+        return
+    if not args.hubs:
+        parser.error('build needs a hubs CSV')
+
+    if args.store and os.path.exists(os.path.join(args.store, 'manifest.json')):
+        from shards import open_shards
+        get_map_data = open_shards(args.store).query
+    elif args.store:
+        from listing_store import open_store
+        get_map_data = open_store(args.store).query
+    else:
+        from listings_db import get_engine, get_map_data
+        get_map_data = functools.partial(get_map_data, engine=get_engine(args.db))
+
+    with open(args.mapbox_key) as f:
+        mapbox_access_token = f.read().rstrip()
+    contour_sets = [[int(m) for m in c.split(',')] for c in args.contours or ['10,20,30,40']]
+    for name, workplace, modes in read_hubs(args.hubs, mapbox_access_token, args.mode or ['driving']):
+        for mode in modes:
+            for contours in contour_sets:
+                added, removed = build_hub(conn, name, workplace, mode, contours, mapbox_access_token, get_map_data, args.full)
+                print(f'{name} {mode} {contours}: {added} locations added, {removed} removed')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+"""
+Incremental listing ingestion, replacing the one-shot steps in get_apt_listings.ipynb.
+
+Streams scraped listing records (the webautomation.io apartments.com export as .json, or .jsonl/.csv with the same
+address/bedrooms/price fields) in chunks, geocodes only addresses that are not already in the database or the geocode
+cache, and upserts each chunk into address_data_sql keyed by a stable listing id. Progress is checkpointed after every
+committed chunk, so rerunning the same command after a crash resumes where it stopped.
+
+    python ingest.py listings.jsonl --chunk-size 500
+"""
+
+import argparse, csv, hashlib, itertools, json, os, re
+
+from sqlalchemy import bindparam, text
+
+from geocoding import get_geocoords_many, normalize_address
+from listings_db import DB_PATH, TABLE, ensure_listing_id, ensure_spatial_index, get_engine, upsert_listings
+
+
+def read_records(path): # yields raw listing dicts one at a time
+    if path.endswith('.csv'):
+        with open(path, newline='') as f:
+            yield from csv.DictReader(f)
+    elif path.endswith('.jsonl'):
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+    else: # webautomation.io session export: {'results': [...]}
+        with open(path) as f:
+            yield from json.load(f)['results']
+
+
+def parse_listing(record): # returns a listing dict without coordinates, or None if the record can't be used
+    address = (record.get('address') or '').strip()
+    price = re.sub(r'[$,\s]', '', str(record.get('price') or '')).split('-')[0]
+    bedrooms = str(record.get('bedrooms') or '').split()
+    if not address or not price.isdigit() or not bedrooms:
+        return None
+
+    bdrms = bedrooms[0].lower().split('-')[0] # '1-2 Beds' is listed under its smallest unit
+    apt_type = 'studio' if bdrms == 'studio' else f'{bdrms}_br'
+    source_id = record.get('listing_id') or record.get('id') or record.get('url')
+    key = str(source_id) if source_id else f'{normalize_address(address)}|{apt_type}'
+    return {
+        'listing_id': hashlib.sha1(key.encode()).hexdigest()[:16],
+        'address': address,
+        'type': apt_type,
+        'rent': int(price),
+        'random_real': 'real',
+    }
+
+
+def load_checkpoint(path, source):
+    if not os.path.exists(path):
+        return 0
+    with open(path) as f:
+        checkpoint = json.load(f)
+    return checkpoint['records_done'] if checkpoint['source'] == os.path.abspath(source) else 0
+
+
+def save_checkpoint(path, source, records_done):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump({'source': os.path.abspath(source), 'records_done': records_done}, f)
+    os.replace(tmp, path) # atomic, so a crash never leaves a half-written checkpoint
+
+
+def known_coords(conn, listings): # listing_id -> (lat, long) for listings already in the table at the same (normalized) address
+    rows = conn.execute(text(f'SELECT listing_id, address, lat, long FROM {TABLE} WHERE listing_id IN :ids AND lat IS NOT NULL')
+                        .bindparams(bindparam('ids', expanding=True)), {'ids': [listing['listing_id'] for listing in listings]})
+    addresses = {listing['listing_id']: normalize_address(listing['address']) for listing in listings}
+    # A listing that kept its id but moved is geocoded again; so are rows stored before the address was recorded
+    return {row[0]: (row[2], row[3]) for row in rows if row[1] == addresses[row[0]]}
+
+
+def ingest(source, mapbox_access_token, engine=None, chunk_size=500, checkpoint_path=None, resume=True):
+    engine = engine or get_engine()
+    ensure_listing_id(engine)
+    ensure_spatial_index(engine) # triggers keep the R*Tree in sync with the upserts below
+    checkpoint_path = checkpoint_path or source + '.checkpoint'
+    records_done = load_checkpoint(checkpoint_path, source) if resume else 0
+    stats = {'records': records_done, 'changed': 0, 'new_addresses': 0, 'skipped': 0}
+
+    records = itertools.islice(read_records(source), records_done, None)
+    while True:
+        chunk = list(itertools.islice(records, chunk_size))
+        if not chunk:
+            break
+        listings = [listing for listing in map(parse_listing, chunk) if listing]
+        stats['skipped'] += len(chunk) - len(listings)
+
+        with engine.connect() as conn:
+            coords = known_coords(conn, listings) if listings else {}
+
+        # Geocode each new address once; get_geocoords_many also checks the persistent geocode cache first
+        new_addresses = list(dict.fromkeys(listing['address'] for listing in listings if listing['listing_id'] not in coords))
+        geocoded = dict(zip(new_addresses, get_geocoords_many(new_addresses, mapbox_access_token)))
+        stats['new_addresses'] += len(new_addresses)
+
+        rows = []
+        for listing in listings:
+            if listing['listing_id'] in coords:
+                lat, long = coords[listing['listing_id']]
+            elif geocoded.get(listing['address']):
+                long, lat = geocoded[listing['address']]
+            else:
+                stats['skipped'] += 1
+                continue
+            rows.append({**listing, 'address': normalize_address(listing['address']), 'lat': lat, 'long': long})
+
+        with engine.begin() as conn:
+            stats['changed'] += upsert_listings(conn, rows)
+        stats['records'] += len(chunk)
+        save_checkpoint(checkpoint_path, source, stats['records'])
+
+    if os.path.exists(checkpoint_path): # finished cleanly, so the next run starts from the top
+        os.remove(checkpoint_path)
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Incrementally load scraped listings into address_data_sql.')
+    parser.add_argument('source', help='.json (webautomation.io export), .jsonl or .csv file of listing records')
+    parser.add_argument('--db', default=DB_PATH)
+    parser.add_argument('--chunk-size', type=int, default=500)
+    parser.add_argument('--checkpoint', help='defaults to <source>.checkpoint')
+    parser.add_argument('--restart', action='store_true', help='ignore any checkpoint and start from the first record')
+    parser.add_argument('--mapbox-key', default='mapbox_key.txt', help='file containing the Mapbox access token')
+    args = parser.parse_args()
+
+    with open(args.mapbox_key) as f:
+        mapbox_access_token = f.read().rstrip()
+
+    stats = ingest(args.source, mapbox_access_token, get_engine(args.db), args.chunk_size, args.checkpoint, resume=not args.restart)
+    print(json.dumps(stats))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+import os
+
+import numpy as np
+import shapely
+from shapely.geometry.polygon import Polygon
+
+from cache import TieredCache
+from mapbox_client import client as mapbox_client
+
+
+ISOCHRONE_PATH = '/isochrone/v1/mapbox/{mode}/{long},{lat}'
+MAX_CONTOURS = 4 # the Mapbox isochrone API accepts at most four contours per request
+ISOCHRONE_BACKEND = os.environ.get('ISOCHRONE_BACKEND', 'mapbox') # 'graph' computes isochrones offline from a road_graph.py network
+ROAD_GRAPH_PATH = os.environ.get('ROAD_GRAPH', 'road_graph.npz')
+
+isochrone_cache = TieredCache('isochrone_cache.db', ttl=7 * 24 * 3600, max_memory=256, max_disk=20_000, name='isochrone')
+
+
+def snap_to_grid(workplace, grid): # rounds (lat, long) to the grid so nearby workplaces share one cache entry
+    if not grid:
+        return tuple(workplace)
+    return tuple(round(round(x / grid) * grid, 6) for x in workplace)
+
+
+def fetch_isochrone_rings(workplace, mode, minutes, mapbox_access_token, client=mapbox_client): # returns the outer ring of each contour, smallest to largest
+    minutes = sorted(minutes)
+    path = ISOCHRONE_PATH.format(mode=mode, long=workplace[1], lat=workplace[0])
+
+    def fetch_group(group):
+        params = {'contours_minutes': ','.join(map(str, group)), 'polygons': 'true', 'access_token': mapbox_access_token}
+        return client.get_json(path, params)['features']
+
+    # Contour groups are independent requests, so they are fetched concurrently
+    groups = [minutes[i:i + MAX_CONTOURS] for i in range(0, len(minutes), MAX_CONTOURS)]
+    responses = client.map(fetch_group, groups) if len(groups) > 1 else [fetch_group(groups[0])]
+    rings = {}
+    for features in responses:
+        for feature in features:
+            rings[feature['properties']['contour']] = feature['geometry']['coordinates'][0]
+    return [rings[m] for m in minutes]
+
+
+def graph_isochrone_rings(workplace, mode, minutes, mapbox_access_token=None, client=None): # same result as fetch_isochrone_rings, from the local road graph
+    from road_graph import isochrone_rings, open_graph
+    return isochrone_rings(open_graph(ROAD_GRAPH_PATH), workplace, mode, minutes)
+
+
+def isochrone_key(workplace, mode, minutes, client=mapbox_client): # cache key for an already snapped workplace and sorted minutes
+    if ISOCHRONE_BACKEND == 'graph': # a rebuilt or different road graph gives different isochrones
+        from road_graph import graph_version
+        backend = f'graph:{os.path.abspath(ROAD_GRAPH_PATH)}@{graph_version(ROAD_GRAPH_PATH)}:'
+    else:
+        backend = client.cache_prefix
+    return f'{backend}{mode}:{workplace[0]},{workplace[1]}:' + ','.join(map(str, minutes))
+
+
+def get_isochrones(workplace, mode, minutes, mapbox_access_token, grid=0.001, cache=isochrone_cache, client=mapbox_client): # workplace = (lat, long), minutes = [10, 20, 30, 40]
+    workplace = snap_to_grid(workplace, grid)
+    minutes = sorted(minutes)
+    fetch = graph_isochrone_rings if ISOCHRONE_BACKEND == 'graph' else fetch_isochrone_rings
+    rings = cache.get(isochrone_key(workplace, mode, minutes, client), lambda: fetch(workplace, mode, minutes, mapbox_access_token, client))
+    return [Polygon(ring) for ring in rings] # create list in order of smallest to largest polygon
+
+
+def get_isochrones_many(workplaces, modes, minutes, mapbox_access_token, grid=0.001, cache=isochrone_cache, client=mapbox_client): # one get_isochrones per (workplace, mode) pair, fetched concurrently
+    return client.map(lambda args: get_isochrones(args[0], args[1], minutes, mapbox_access_token, grid, cache, client), list(zip(workplaces, modes)))
+
+
+def map_tolerance(zoom, pixels=1): # degrees spanned by `pixels` screen pixels on a web-mercator map at this zoom
+    return 360 / (256 * 2 ** zoom) * pixels
+
+
+def ring_geometries(polys, tolerance=0.0, precision=5): # GeoJSON for the map layers: the rings between contours from largest to smallest, then the smallest polygon
+    # Simplify each contour once, then difference the simplified contours, so neighbouring rings share their edges exactly
+    grid_size = 10 ** -precision
+    polys = [shapely.set_precision(p.simplify(tolerance, preserve_topology=True) if tolerance else p, grid_size) for p in polys]
+    rings = [polys[i] - polys[i - 1] for i in range(len(polys) - 1, 0, -1)] + [polys[0]]
+    rings = [shapely.transform(shapely.set_precision(ring, grid_size), lambda coords: np.round(coords, precision)) for ring in rings]
+    return [ring.__geo_interface__ for ring in rings]
+
+
+def get_isochrone_layers(workplace, mode, minutes, mapbox_access_token, zoom=12, grid=0.001, cache=isochrone_cache, client=mapbox_client): # ring_geometries for get_isochrones, simplified to a pixel at zoom and cached next to the isochrones
+    workplace = snap_to_grid(workplace, grid)
+    minutes = sorted(minutes)
+    key = isochrone_key(workplace, mode, minutes, client) + f':rings@{zoom}'
+    return cache.get(key, lambda: ring_geometries(get_isochrones(workplace, mode, minutes, mapbox_access_token, grid, cache, client), map_tolerance(zoom)))
@@ -0,0 +1,170 @@
+"""
+Columnar, memory-mapped listing store: an alternative to reading address_data_sql into a fresh DataFrame per session.
+
+A store is a directory with one .npy file per column plus meta.json. Coordinates are float32, rent is int32 and the
+low-cardinality text columns (type, random_real) are int8 codes with their categories kept in meta.json. Rows are sorted
+into spatially coherent row groups whose lat/long bounds are recorded, so a bounding-box query only touches the groups
+that intersect it. Columns are opened with np.load(mmap_mode='r'), so every session and server process on a machine
+shares one page-cached copy.
+
+    python listing_store.py build                 # address_data_sql.db -> listings_store/
+    LISTING_BACKEND=store streamlit run apartments_streamlit_isochrone.py
+"""
+
+import argparse, json, os, shutil, threading
+
+import numpy as np
+import pandas as pd
+
+
+STORE_PATH = 'listings_store'
+ROW_GROUP_SIZE = 65536
+CATEGORICAL = ['type', 'random_real']
+DTYPES = {'lat': 'float32', 'long': 'float32', 'rent': 'int32', 'type': 'int8', 'random_real': 'int8'}
+
+
+def build_store(df, path=STORE_PATH, row_group_size=ROW_GROUP_SIZE): # writes df (lat, long, rent, type, random_real) as a store directory
+    df = df.dropna(subset=['lat', 'long'])
+    # Sort by 0.1 degree latitude band, then longitude, so each row group covers a compact area
+    order = np.lexsort((df['long'].to_numpy(), np.floor(df['lat'].to_numpy() * 10)))
+    df = df.iloc[order]
+
+    # Build next to the old store and swap it in: running apps have the old columns memory-mapped, and rewriting those
+    # files in place would change (or truncate) the pages under them
+    final, path = path, path.rstrip('/\\') + '.tmp'
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path)
+    meta = {'rows': len(df), 'row_group_size': row_group_size, 'columns': {}, 'row_groups': []}
+    for column, dtype in DTYPES.items():
+        if column in CATEGORICAL:
+            values = pd.Categorical(df[column])
+            meta['columns'][column] = {'dtype': dtype, 'categories': [str(c) for c in values.categories]}
+            values = values.codes
+        else:
+            meta['columns'][column] = {'dtype': dtype}
+            values = df[column].to_numpy()
+        np.save(os.path.join(path, f'{column}.npy'), np.ascontiguousarray(values, dtype=dtype))
+
+    lat, long = df['lat'].to_numpy(), df['long'].to_numpy()
+    for start in range(0, len(df), row_group_size):
+        stop = min(start + row_group_size, len(df))
+        meta['row_groups'].append({'start': start, 'stop': stop,
+                                   'bounds': [float(long[start:stop].min()), float(lat[start:stop].min()),
+                                              float(long[start:stop].max()), float(lat[start:stop].max())]})
+
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+
+    old = final.rstrip('/\\') + '.old'
+    shutil.rmtree(old, ignore_errors=True)
+    if os.path.exists(final):
+        os.replace(final, old)
+    os.replace(path, final)
+    shutil.rmtree(old, ignore_errors=True) # processes still mapping the old columns keep them until they reopen the store
+
+
+def store_version(path=STORE_PATH): # changes whenever build_store swaps in a new store; None while there is none
+    try:
+        stat = os.stat(os.path.join(path, 'meta.json'))
+    except FileNotFoundError:
+        return None
+    return (stat.st_ino, stat.st_mtime_ns)
+
+
+class ListingStore:
+
+    def __init__(self, path=STORE_PATH):
+        self.version = store_version(path)
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        # Memory-mapped and read-only: pages are loaded lazily and shared through the OS page cache
+        self.columns = {column: np.load(os.path.join(path, f'{column}.npy'), mmap_mode='r') for column in self.meta['columns']}
+
+    def __len__(self):
+        return self.meta['rows']
+
+    def row_ranges(self, bbox=None): # (start, stop) runs of row groups intersecting bbox = (min_long, min_lat, max_long, max_lat)
+        if bbox is None:
+            return [(0, len(self))]
+        ranges = []
+        for group in self.meta['row_groups']:
+            g = group['bounds']
+            if g[0] <= bbox[2] and g[2] >= bbox[0] and g[1] <= bbox[3] and g[3] >= bbox[1]:
+                if ranges and ranges[-1][1] == group['start']: # merge adjacent groups so a contiguous run stays a zero-copy slice
+                    ranges[-1] = (ranges[-1][0], group['stop'])
+                else:
+                    ranges.append((group['start'], group['stop']))
+        return ranges
+
+    def column(self, name, ranges): # raw values for the row ranges; a single range is a view of the memory map, several are concatenated
+        values = self.columns[name]
+        if len(ranges) == 1:
+            return values[ranges[0][0]:ranges[0][1]]
+        return np.concatenate([values[start:stop] for start, stop in ranges]) if ranges else values[:0]
+
+    def load(self, columns=None, bbox=None): # DataFrame of the requested columns over the row groups intersecting bbox
+        ranges = self.row_ranges(bbox)
+        data = {}
+        for name in columns or list(self.columns):
+            values = self.column(name, ranges)
+            if name in CATEGORICAL:
+                values = pd.Categorical.from_codes(values, categories=self.meta['columns'][name]['categories'], validate=False)
+            data[name] = values
+        return pd.DataFrame(data, copy=False)
+
+    def query(self, rental_range, apt_types, bbox=None, columns=None): # same filters as listings_db.get_map_data, None skips one; only the matching rows are copied out of the map
+        ranges = self.row_ranges(bbox)
+        lat, long, rent = (self.column(name, ranges) for name in ['lat', 'long', 'rent'])
+
+        mask = np.ones(len(lat), dtype=bool)
+        if rental_range is not None:
+            mask &= (rent >= rental_range[0]) & (rent <= rental_range[1])
+        if apt_types is not None:
+            type_codes = [self.meta['columns']['type']['categories'].index(t) for t in apt_types if t in self.meta['columns']['type']['categories']]
+            mask &= np.isin(self.column('type', ranges), type_codes)
+        if bbox is not None:
+            mask &= (long >= bbox[0]) & (long <= bbox[2]) & (lat >= bbox[1]) & (lat <= bbox[3])
+        rows = np.flatnonzero(mask)
+
+        data = {}
+        for name in columns or list(self.columns):
+            values = self.column(name, ranges)[rows]
+            if name in CATEGORICAL:
+                values = pd.Categorical.from_codes(values, categories=self.meta['columns'][name]['categories'], validate=False)
+            data[name] = values
+        return pd.DataFrame(data, copy=False)
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def open_store(path=STORE_PATH): # one ListingStore per path per process, shared by every session and reopened after a rebuild
+    version = store_version(path)
+    with _stores_lock:
+        # Mid-swap there's briefly no meta.json; keep serving the old store until the new one is in place
+        if path not in _stores or (version is not None and version != _stores[path].version):
+            _stores[path] = ListingStore(path)
+        return _stores[path]
+
+
+def get_map_data(rental_range, apt_types, bbox=None, path=STORE_PATH): # drop-in for listings_db.get_map_data
+    return open_store(path).query(rental_range, apt_types, bbox)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build a memory-mapped listing store from address_data_sql.')
+    parser.add_argument('command', choices=['build'])
+    parser.add_argument('--db', default='address_data_sql.db')
+    parser.add_argument('--out', default=STORE_PATH)
+    parser.add_argument('--row-group-size', type=int, default=ROW_GROUP_SIZE)
+    args = parser.parse_args()
+
+    from listings_db import TABLE, get_engine
+    df = pd.read_sql(f'SELECT lat, long, rent, type, random_real FROM {TABLE}', get_engine(args.db))
+    build_store(df, args.out, args.row_group_size)
+    print(f'wrote {len(df)} listings to {args.out}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+"""
+SQLite access to the address_data_sql listings table.
+
+Bounding-box queries use an R*Tree side index when the database has one. ingest.py builds and maintains it; for a
+database loaded some other way (such as the prototype address_data_sql.db), build it once with
+
+    python listings_db.py index --db address_data_sql.db
+
+Searches never write to the database, so it can be deployed read-only; without the index they fall back to scanning
+the table.
+"""
+
+import argparse, threading
+
+import pandas as pd
+from sqlalchemy import create_engine, text, bindparam
+
+
+DB_PATH = 'address_data_sql.db'
+TABLE = 'address_data_sql'
+RTREE = 'address_data_rtree'
+
+
+_engines = {}
+_indexed = set() # engines known to have the R*Tree
+_engines_lock = threading.Lock()
+
+
+def get_engine(path=DB_PATH): # one engine (and connection pool) per database file per process
+    with _engines_lock:
+        if path not in _engines:
+            _engines[path] = create_engine(f'sqlite:///{path}')
+        return _engines[path]
+
+
+def ensure_spatial_index(engine, table=TABLE, rtree=RTREE): # creates the R*Tree + (type, rent) index once; triggers keep the R*Tree in sync with every later insert/update/delete
+    with engine.begin() as conn:
+        new_rtree = conn.execute(text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"), {'name': rtree}).first() is None
+
+        conn.execute(text(f'CREATE VIRTUAL TABLE IF NOT EXISTS {rtree} USING rtree(id, min_lat, max_lat, min_long, max_long)'))
+        conn.execute(text(f'CREATE INDEX IF NOT EXISTS ix_{table}_type_rent ON {table} (type, rent)'))
+
+        # Listings are points, so each R*Tree box is degenerate (min == max)
+        conn.execute(text(f'''
+            CREATE TRIGGER IF NOT EXISTS {table}_rtree_insert AFTER INSERT ON {table}
+            WHEN new.lat IS NOT NULL AND new.long IS NOT NULL
+            BEGIN
+                INSERT OR REPLACE INTO {rtree} VALUES (new.rowid, new.lat, new.lat, new.long, new.long);
+            END'''))
+        conn.execute(text(f'''
+            CREATE TRIGGER IF NOT EXISTS {table}_rtree_update AFTER UPDATE OF lat, long ON {table}
+            BEGIN
+                DELETE FROM {rtree} WHERE id = old.rowid;
+                INSERT INTO {rtree} SELECT new.rowid, new.lat, new.lat, new.long, new.long WHERE new.lat IS NOT NULL AND new.long IS NOT NULL;
+            END'''))
+        conn.execute(text(f'''
+            CREATE TRIGGER IF NOT EXISTS {table}_rtree_delete AFTER DELETE ON {table}
+            BEGIN
+                DELETE FROM {rtree} WHERE id = old.rowid;
+            END'''))
+
+        if new_rtree: # backfill rows written before the index existed
+            conn.execute(text(f'INSERT OR REPLACE INTO {rtree} SELECT rowid, lat, lat, long, long FROM {table} WHERE lat IS NOT NULL AND long IS NOT NULL'))
+    _indexed.add(engine)
+
+
+def ensure_listing_id(engine, table=TABLE): # adds the stable listing_id key that ingestion upserts on, and the normalized address its coordinates were geocoded from; rows from the original prototype load keep NULLs
+    with engine.begin() as conn:
+        conn.execute(text(f'''
+            CREATE TABLE IF NOT EXISTS {table} (
+                "index" BIGINT, lat FLOAT, long FLOAT, type TEXT, rent BIGINT, random_real TEXT, listing_id TEXT, address TEXT
+            )'''))
+        columns = [row[1] for row in conn.execute(text(f'PRAGMA table_info({table})'))]
+        for column in ['listing_id', 'address']:
+            if column not in columns:
+                conn.execute(text(f'ALTER TABLE {table} ADD COLUMN {column} TEXT'))
+        conn.execute(text(f'CREATE UNIQUE INDEX IF NOT EXISTS ux_{table}_listing_id ON {table} (listing_id)'))
+
+
+def upsert_listings(conn, rows, table=TABLE): # rows are dicts with listing_id, address, lat, long, type, rent, random_real; unchanged rows are left untouched. Returns the number of rows written
+    if not rows:
+        return 0
+    return conn.execute(text(f'''
+        INSERT INTO {table} (listing_id, address, lat, long, type, rent, random_real)
+        VALUES (:listing_id, :address, :lat, :long, :type, :rent, :random_real)
+        ON CONFLICT (listing_id) DO UPDATE SET
+            address = excluded.address, lat = excluded.lat, long = excluded.long, type = excluded.type, rent = excluded.rent,
+            random_real = excluded.random_real
+        WHERE address IS NOT excluded.address OR lat IS NOT excluded.lat OR long IS NOT excluded.long OR type IS NOT excluded.type
+            OR rent IS NOT excluded.rent OR random_real IS NOT excluded.random_real'''), rows).rowcount
+
+
+def has_spatial_index(engine, rtree=RTREE): # read-only check; remembered once the index exists, rechecked until then
+    if engine not in _indexed:
+        with engine.connect() as conn:
+            if conn.execute(text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"), {'name': rtree}).first() is not None:
+                _indexed.add(engine)
+    return engine in _indexed
+
+
+def get_map_data(rental_range, apt_types, bbox=None, engine=None): # bbox = (min_long, min_lat, max_long, max_lat), same order as shapely's .bounds; None skips a filter
+    engine = engine or get_engine()
+
+    params, where = {}, []
+    if rental_range is not None:
+        params.update(low=rental_range[0], high=rental_range[1])
+        where.append('a.rent BETWEEN :low AND :high')
+    if apt_types is not None:
+        params['types'] = list(apt_types)
+        where.append('a.type IN :types')
+    if bbox is None:
+        query = f'SELECT * FROM {TABLE} a'
+    elif not has_spatial_index(engine):
+        query = f'SELECT * FROM {TABLE} a WHERE a.lat BETWEEN :min_lat AND :max_lat AND a.long BETWEEN :min_long AND :max_long'
+        params.update(zip(['min_long', 'min_lat', 'max_long', 'max_lat'], bbox))
+    else:
+        # The R*Tree stores 32-bit floats rounded outward, so the exact lat/long check removes the few points it lets through at the edges
+        query = f'''
+            SELECT a.* FROM {TABLE} a JOIN {RTREE} r ON a.rowid = r.id
+            WHERE r.min_lat <= :max_lat AND r.max_lat >= :min_lat AND r.min_long <= :max_long AND r.max_long >= :min_long
+            AND a.lat BETWEEN :min_lat AND :max_lat AND a.long BETWEEN :min_long AND :max_long'''
+        params.update(zip(['min_long', 'min_lat', 'max_long', 'max_lat'], bbox))
+    if where:
+        query += (' AND ' if bbox is not None else ' WHERE ') + ' AND '.join(where)
+
+    query = text(query)
+    if apt_types is not None:
+        query = query.bindparams(bindparam('types', expanding=True))
+    with engine.connect() as conn:
+        return pd.read_sql(query, conn, params=params)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build the spatial index that bounding-box listing queries use.')
+    parser.add_argument('command', choices=['index'])
+    parser.add_argument('--db', default=DB_PATH)
+    args = parser.parse_args()
+
+    ensure_spatial_index(get_engine(args.db))
+    print(f'{args.db}: spatial index ready')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+import contextvars, os, random, threading, time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import record_mapbox_request
+
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+MAPBOX_API_URL = 'https://api.mapbox.com'
+
+
+class RateLimiter:
+    # Token bucket: allows bursts of up to `burst` requests, refilled at `rate` requests per second
+
+    def __init__(self, rate=10, burst=10):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class MapboxClient:
+    # Shared keep-alive connection pool plus a thread pool for issuing independent Mapbox calls concurrently.
+    # Every request has a timeout, passes through the rate limiter and is retried with jittered backoff on 429/5xx and connection errors.
+
+    def __init__(self, base_url=MAPBOX_API_URL, timeout=10, retries=3, backoff=0.5, rate=10, burst=10, max_workers=8):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.limiter = RateLimiter(rate, burst)
+        self.stats = {'requests': 0, 'retries': 0, 'errors': 0}
+        self._stats_lock = threading.Lock()
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='mapbox')
+        self._worker = threading.local() # set on the pool's own threads
+
+    @property
+    def cache_prefix(self): # for cache keys of responses, so answers from a stub or proxy never mix with real Mapbox answers in the shared caches
+        return '' if self.base_url == MAPBOX_API_URL else f'{self.base_url}|'
+
+    def _count(self, name):
+        with self._stats_lock:
+            self.stats[name] += 1
+
+    def _sleep_before_retry(self, attempt, response=None):
+        retry_after = response is not None and response.headers.get('Retry-After')
+        if retry_after and retry_after.isdigit():
+            delay = int(retry_after)
+        else:
+            delay = self.backoff * 2 ** attempt * random.uniform(0.5, 1.5) # jitter keeps concurrent sessions from retrying in lockstep
+        time.sleep(delay)
+
+    def get_json(self, path, params=None): # path is relative to base_url, e.g. '/isochrone/v1/mapbox/driving/-77.1,38.9'
+        url = self.base_url + path
+        endpoint = path.strip('/').split('/')[0] # 'geocoding' or 'isochrone'
+        for attempt in range(self.retries + 1):
+            self.limiter.acquire()
+            self._count('requests')
+            start = time.perf_counter()
+            try:
+                r = self.session.get(url, params=params, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout):
+                record_mapbox_request(endpoint, None, time.perf_counter() - start, attempt)
+                if attempt == self.retries:
+                    self._count('errors')
+                    raise
+                self._count('retries')
+                self._sleep_before_retry(attempt)
+                continue
+
+            record_mapbox_request(endpoint, r.status_code, time.perf_counter() - start, attempt)
+            if r.status_code in RETRY_STATUSES and attempt < self.retries:
+                self._count('retries')
+                self._sleep_before_retry(attempt, r)
+                continue
+            if not r.ok:
+                self._count('errors')
+            r.raise_for_status()
+            return r.json()
+
+    def map(self, fn, items): # runs fn over items on the client's thread pool, returning results in order
+        # A map called from inside another map's fn runs inline: queueing it on the same pool could wait forever on busy workers
+        if getattr(self._worker, 'active', False):
+            return [fn(item) for item in items]
+
+        def run(call): # each call runs in a copy of the caller's context so the worker threads report into the caller's request trace
+            self._worker.active = True
+            try:
+                return call[0].run(fn, call[1])
+            finally:
+                self._worker.active = False
+
+        return list(self._executor.map(run, [(contextvars.copy_context(), item) for item in items]))
+
+
+client = MapboxClient(os.environ.get('MAPBOX_API_URL', MAPBOX_API_URL)) # point MAPBOX_API_URL at a MapboxStub to run the apps offline
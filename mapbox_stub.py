@@ -0,0 +1,114 @@
+"""
+Local stand-in for the Mapbox geocoding and isochrone APIs.
+
+Answers the same URL paths as api.mapbox.com so MapboxClient(base_url=stub.url) can be exercised with no network or
+access token. Geocodes and isochrones come from recorded fixtures when one matches, otherwise they are synthesized:
+addresses hash to a point near Arlington, VA and isochrones are circles whose radius grows with the contour minutes.
+
+    with MapboxStub(fail_first=2) as stub: # the first two requests answer 503 to exercise retries
+        client = MapboxClient(base_url=stub.url)
+"""
+
+import hashlib, json, math, threading, time, urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from geocoding import normalize_address
+
+
+CENTER = 38.8816, -77.1166 # (lat, long) of the default workplace
+MILES_PER_MINUTE = {'driving': 0.5, 'cycling': 0.2, 'walking': 0.05}
+
+
+def synthetic_geocode(address): # stable pseudo-random [long, lat] within ~10 miles of CENTER
+    digest = hashlib.sha1(address.encode()).digest()
+    dlat = (digest[0] / 255 - 0.5) * 0.3
+    dlong = (digest[1] / 255 - 0.5) * 0.3
+    return [CENTER[1] + dlong, CENTER[0] + dlat]
+
+
+def synthetic_isochrone(long, lat, mode, minutes, vertices=64): # circular contour as a GeoJSON feature
+    radius = minutes * MILES_PER_MINUTE.get(mode, 0.5) / 69 # miles -> degrees of latitude
+    ring = [[long + radius * math.cos(2 * math.pi * i / vertices) / math.cos(math.radians(lat)), lat + radius * math.sin(2 * math.pi * i / vertices)]
+            for i in range(vertices)]
+    ring.append(ring[0])
+    return {'type': 'Feature', 'properties': {'contour': minutes}, 'geometry': {'type': 'Polygon', 'coordinates': [ring]}}
+
+
+class MapboxStub:
+
+    def __init__(self, fixtures=None, latency=0.0, fail_first=0, fail_status=503):
+        self.fixtures = fixtures or {} # {'geocode': {normalized address: [long, lat]}, 'isochrone': {'mode:long,lat': [feature, ...]}}
+        self.latency = latency # seconds added to every response
+        self.fail_first = fail_first
+        self.fail_status = fail_status
+        self.requests = []
+        self._lock = threading.Lock()
+        self._server = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self):
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def respond(self, path, query): # returns (status, body) for a request path
+        with self._lock:
+            self.requests.append(path)
+            failing = len(self.requests) <= self.fail_first
+        if self.latency:
+            time.sleep(self.latency)
+        if failing:
+            return self.fail_status, {'message': 'stub failure'}
+
+        parts = path.strip('/').split('/')
+        if parts[:3] == ['geocoding', 'v5', 'mapbox.places']:
+            address = urllib.parse.unquote(parts[3]).removesuffix('.json')
+            center = self.fixtures.get('geocode', {}).get(normalize_address(address)) or synthetic_geocode(address)
+            return 200, {'type': 'FeatureCollection', 'features': [{'center': center, 'place_name': address}]}
+
+        if parts[:3] == ['isochrone', 'v1', 'mapbox'] and len(parts) == 5:
+            mode, coordinates = parts[3], parts[4]
+            long, lat = map(float, coordinates.split(','))
+            minutes = [int(m) for m in query.get('contours_minutes', ['10'])[0].split(',')]
+            recorded = {f['properties']['contour']: f for f in self.fixtures.get('isochrone', {}).get(f'{mode}:{coordinates}', [])}
+            features = [recorded.get(m) or synthetic_isochrone(long, lat, mode, m) for m in sorted(minutes, reverse=True)] # Mapbox lists the largest contour first
+            return 200, {'type': 'FeatureCollection', 'features': features}
+
+        return 404, {'message': 'Not Found'}
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1' # keep-alive, like the real API
+            disable_nagle_algorithm = True # headers and body go out in separate writes; without this each response waits on a delayed ACK
+
+            def do_GET(self):
+                url = urllib.parse.urlsplit(self.path)
+                status, body = stub.respond(url.path, urllib.parse.parse_qs(url.query))
+                body = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
@@ -0,0 +1,193 @@
+"""
+Per-stage timing and Mapbox call instrumentation for the submit path of both apps.
+
+Every instrumented event is written as one JSON line to the 'apartments.metrics' logger and aggregated in a process-wide
+registry that renders Prometheus text format, either to a file (write_prometheus) or over HTTP (serve_metrics, or set
+METRICS_PORT). Stages run inside a request trace, which the apps can show as a per-request breakdown in a debug panel.
+
+    with request_trace('isochrone') as trace:
+        with stage('load', rows_in=None) as s:
+            results = get_map_data(...)
+            s.rows_out = len(results)
+    trace.records # [{'stage': 'load', 'seconds': ..., 'rows_in': None, 'rows_out': 5026}]
+"""
+
+import contextvars, json, logging, os, sys, threading, time, uuid
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+logger = logging.getLogger('apartments.metrics')
+if not logger.handlers:
+    _handler = logging.StreamHandler(sys.stderr)
+    _handler.setFormatter(logging.Formatter('%(message)s'))
+    logger.addHandler(_handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float('inf'))
+
+
+class Registry:
+    # Counters and latency histograms keyed by (name, sorted label items)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {} # key -> [bucket counts..., sum, count]
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            hist = self.histograms.setdefault(key, [0] * len(LATENCY_BUCKETS) + [0.0, 0])
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    hist[i] += 1
+            hist[-2] += seconds
+            hist[-1] += 1
+
+    def render(self): # Prometheus text exposition format
+        def fmt(labels, extra=()):
+            items = list(labels) + list(extra)
+            return '{' + ','.join(f'{k}="{v}"' for k, v in items) + '}' if items else ''
+
+        lines = []
+        with self._lock:
+            for name in sorted({key[0] for key in self.counters}):
+                lines.append(f'# TYPE {name} counter')
+                lines += [f'{name}{fmt(labels)} {value}' for (n, labels), value in sorted(self.counters.items()) if n == name]
+            for name in sorted({key[0] for key in self.histograms}):
+                lines.append(f'# TYPE {name} histogram')
+                for (n, labels), hist in sorted(self.histograms.items()):
+                    if n != name:
+                        continue
+                    for bound, count in zip(LATENCY_BUCKETS, hist):
+                        lines.append(f'{name}_bucket{fmt(labels, [("le", "+Inf" if bound == float("inf") else bound)])} {count}')
+                    lines.append(f'{name}_sum{fmt(labels)} {hist[-2]}')
+                    lines.append(f'{name}_count{fmt(labels)} {hist[-1]}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+def log_event(event, **fields):
+    trace = _current_trace.get()
+    if trace is not None:
+        fields.setdefault('request_id', trace.request_id)
+    logger.info(json.dumps({'event': event, 'ts': round(time.time(), 3), **fields}, default=str))
+
+
+class RequestTrace:
+    # Stage records for one submit, for the debug panel
+
+    def __init__(self, app):
+        self.app = app
+        self.request_id = uuid.uuid4().hex[:12]
+        self.records = []
+        self.mapbox_calls = []
+
+
+_current_trace = contextvars.ContextVar('request_trace', default=None)
+
+
+@contextmanager
+def request_trace(app):
+    trace = RequestTrace(app)
+    token = _current_trace.set(trace)
+    start = time.perf_counter()
+    try:
+        yield trace
+    finally:
+        seconds = time.perf_counter() - start
+        _current_trace.reset(token)
+        registry.observe('app_request_seconds', seconds, app=app)
+        log_event('request', request_id=trace.request_id, app=app, seconds=round(seconds, 6))
+
+
+class _Stage:
+    def __init__(self, name, rows_in):
+        self.name = name
+        self.rows_in = rows_in
+        self.rows_out = None
+
+
+@contextmanager
+def stage(name, rows_in=None): # times the block; set .rows_out on the yielded object to record the stage's output size
+    s = _Stage(name, rows_in)
+    trace = _current_trace.get()
+    start = time.perf_counter()
+    status = 'error'
+    try:
+        yield s
+        status = 'ok'
+    finally:
+        seconds = time.perf_counter() - start
+        app = trace.app if trace else 'none'
+        registry.observe('app_stage_seconds', seconds, app=app, stage=name)
+        if s.rows_in is not None:
+            registry.inc('app_stage_rows_in_total', s.rows_in, app=app, stage=name)
+        if s.rows_out is not None:
+            registry.inc('app_stage_rows_out_total', s.rows_out, app=app, stage=name)
+        record = {'stage': name, 'seconds': round(seconds, 6), 'rows_in': s.rows_in, 'rows_out': s.rows_out, 'status': status}
+        if trace is not None:
+            trace.records.append(record)
+        log_event('stage', app=app, **record)
+
+
+def record_mapbox_request(endpoint, status, seconds, attempt): # called by MapboxClient for every HTTP attempt; status is None on connection errors
+    registry.observe('mapbox_request_seconds', seconds, endpoint=endpoint)
+    registry.inc('mapbox_requests_total', endpoint=endpoint, status=status or 'error')
+    if attempt:
+        registry.inc('mapbox_retries_total', endpoint=endpoint)
+    call = {'endpoint': endpoint, 'status': status, 'seconds': round(seconds, 6), 'attempt': attempt}
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.mapbox_calls.append(call)
+    log_event('mapbox_request', **call)
+
+
+def record_cache_lookup(cache, result): # result is 'memory_hits', 'disk_hits', 'misses' or 'coalesced'
+    registry.inc('cache_lookups_total', cache=cache, result=result)
+
+
+def write_prometheus(path='metrics.prom'): # atomic, so a node_exporter textfile collector never reads a partial file
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        f.write(registry.render())
+    os.replace(tmp, path)
+
+
+_server = None
+
+
+def serve_metrics(port): # starts a /metrics endpoint once per process
+    global _server
+    if _server is not None:
+        return _server
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = registry.render().encode()
+            self.send_response(200 if self.path.startswith('/metrics') else 404)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    _server = ThreadingHTTPServer(('0.0.0.0', port), Handler)
+    _server.daemon_threads = True
+    threading.Thread(target=_server.serve_forever, daemon=True).start()
+    return _server
+
+
+if os.environ.get('METRICS_PORT'):
+    serve_metrics(int(os.environ['METRICS_PORT']))
@@ -0,0 +1,272 @@
+import functools
+
+import numpy as np
+import pandas as pd
+import plotly.graph_objects as go
+import plotly.express as px
+from plotly.colors import sample_colorscale, unlabel_rgb
+
+from commute import monthly_commute_cost
+from geocoding import get_geocoords, get_geocoords_many
+from hubs import find_hub
+from isochrones import get_isochrones, get_isochrones_many, map_tolerance, ring_geometries
+from stages import StageGraph
+from zones import classify_nested_zones, interpolate_commute_minutes, zone_labels
+
+
+MAP_ZOOM = 12
+LOD_MAX_POINTS = 5000 # above this many listings the map shows grid cells instead of individual markers
+LOD_CELL_PIXELS = 16
+
+def zone_colors(n): # (r, g, b) per zone from smallest to largest isochrone; the default four zones keep the original green/yellow/red/blue
+    if n == 4:
+        return [(0, 128, 0), (255, 255, 0), (255, 0, 0), (0, 0, 255)]
+    return [tuple(int(c) for c in unlabel_rgb(color)) for color in sample_colorscale('Turbo', n)]
+
+
+def household_commute_matrix(results, commuters, contours): # (zones, minutes), each an N x M array for N commuters and M listings; commuters are dicts with 'workplace' and 'polys', and optionally a precomputed 'hub'
+    lat, long = results['lat'].to_numpy(), results['long'].to_numpy()
+    zones = np.empty((len(commuters), len(results)), dtype='int64')
+    minutes = np.empty((len(commuters), len(results)))
+    for i, commuter in enumerate(commuters):
+        if commuter.get('hub') is not None:
+            zones[i], minutes[i] = commuter['hub'].commute(lat, long)
+            continue
+        zones[i] = classify_nested_zones(lat, long, commuter['polys'])
+        minutes[i] = interpolate_commute_minutes(lat, long, zones[i], commuter['polys'], contours, commuter['workplace'])
+    return zones, minutes
+
+
+def apply_commute_costs(results, zones, minutes, wages, contours): # adds zone/commute columns from household_commute_matrix and the combined adjusted rent
+    wages = np.asarray(wages, dtype='float64')
+    results['adjusted_rent'] = (results['rent'] + monthly_commute_cost(minutes, wages[:, None]).sum(axis=0)).astype('int')
+
+    labels = np.array(zone_labels(contours))
+    if len(wages) == 1: # zone, commute_min and 'commute time (minutes)', the columns cheapest_per_zone reads
+        results['zone'] = zones[0]
+        results['commute_min'] = minutes[0].round().astype('int')
+        results['commute time (minutes)'] = labels[zones[0]]
+        return results
+    for i in range(len(wages)):
+        results[f'commute {i + 1} (minutes)'] = labels[zones[i]]
+        results[f'commute_min_{i + 1}'] = minutes[i].round().astype('int')
+    results['zone'] = zones.max(axis=0) # the longest of the household's commutes
+    return results
+
+
+def price_household(results, commuters, contours): # per-commuter zone and commute columns plus the household's combined adjusted rent; commuters also need 'hourly_income'
+    zones, minutes = household_commute_matrix(results, commuters, contours)
+    return apply_commute_costs(results, zones, minutes, [commuter['hourly_income'] for commuter in commuters], contours)
+
+
+def cheapest_for_household(results, n_commuters, k=10): # the k lowest combined effective rents, ready for st.table
+    results = results.nsmallest(k, 'adjusted_rent', keep='first').rename(columns={'adjusted_rent': 'effective rent'})
+    columns = ['rent', 'effective rent', 'lat', 'long', 'random_real', 'type']
+    for i in range(1, n_commuters + 1):
+        results = results.rename(columns={f'commute_min_{i}': f'est. commute {i} (minutes)'})
+        columns += [f'commute {i} (minutes)', f'est. commute {i} (minutes)']
+    return results.reindex(columns=columns).reset_index(drop=True)
+
+
+def create_plotly_isochrones(polygons, colors, opacity=0.15, rings=None): # enter list of polygons (or their precomputed ring_geometries) and func will output code for plotly
+    assert len(polygons) == len(colors), 'check length of inputs'
+    layers = rings if rings is not None else ring_geometries(polygons)
+
+    layers = [{'source': layers[i], 'type': 'fill', 'color': colors[i], 'opacity': opacity} for i in range(len(layers))]
+
+    return layers
+
+
+def aggregate_listings(results, zoom=MAP_ZOOM, max_cells=LOD_MAX_POINTS, pixels=LOD_CELL_PIXELS): # bins listings into square grid cells with count and min/median adjusted rent
+    lat, long = results['lat'].to_numpy(), results['long'].to_numpy()
+    cell = map_tolerance(zoom, pixels) # longitude span of a cell `pixels` wide
+    lat_scale = np.cos(np.radians(np.median(lat))) # a degree of latitude is taller than a degree of longitude on the map
+    # Coarsen the grid until the cell count fits the budget, so the payload is bounded however many listings there are
+    while True:
+        row, col = np.floor(lat / (cell * lat_scale)).astype('int64'), np.floor(long / cell).astype('int64')
+        keys = (row - row.min()) * (col.max() - col.min() + 1) + (col - col.min())
+        if len(np.unique(keys)) <= max_cells:
+            break
+        cell *= 2
+
+    cells = results.groupby(keys).agg(lat=('lat', 'mean'), long=('long', 'mean'), listings=('adjusted_rent', 'size'),
+                                      min_rent=('adjusted_rent', 'min'), median_rent=('adjusted_rent', 'median'))
+    cells['median_rent'] = cells['median_rent'].round().astype('int')
+    return cells.reset_index(drop=True)
+
+
+# There is a bug in plotly where if you set the marker style, the color defaults to gray.
+# https://github.com/plotly/plotly.py/issues/2485
+# https://github.com/plotly/plotly.js/issues/2813 ('Note that the array `marker.color` and `marker.size`', are only available for *circle* symbols.')
+# https://stackoverflow.com/questions/59628536/option-symbol-in-scattermapbox-is-not-working
+# https://plotly.com/python/reference/scattermapbox/ Sets the marker symbol. Full list: https://www.mapbox.com/maki-icons/ Note that the array `marker.color` and `marker.size` are only available for "circle" symbols.
+
+def build_map_figure(results, workplace, polys, zone_rgb, mapbox_access_token, max_points=LOD_MAX_POINTS, rings=None, other_workplaces=()): # listings colored by adjusted rent over the isochrone rings, with a star at each workplace
+    px.set_mapbox_access_token(mapbox_access_token)
+    if len(results) <= max_points:
+        fig = px.scatter_mapbox(results, lat="lat", lon="long", hover_name="type", hover_data=["rent", "zone", "random_real"],
+                                color="adjusted_rent", zoom=MAP_ZOOM, height=600)
+    else:
+        # Too many listings for individual markers: one marker per grid cell, sized by count and colored by median adjusted rent
+        cells = aggregate_listings(results, MAP_ZOOM, max_points)
+        fig = px.scatter_mapbox(cells, lat="lat", lon="long", size="listings", size_max=20, hover_data=["listings", "min_rent", "median_rent"],
+                                color="median_rent", labels={"median_rent": "adjusted_rent"}, zoom=MAP_ZOOM, height=600)
+
+    fig.update_layout(mapbox_style="light")
+    fig.update_layout(margin={"r":0,"t":0,"l":0,"b":0})
+
+    workplaces = [workplace, *other_workplaces]
+    fig.add_trace(go.Scattermapbox(
+            lat=[w[0] for w in workplaces],
+            lon=[w[1] for w in workplaces],
+            marker=go.scattermapbox.Marker(
+            size=25,
+            color='red',
+            ),
+            marker_symbol = 'star',
+            hoverinfo = 'none',
+            showlegend = False
+            )
+        )
+
+    fig.update_layout(
+        mapbox = {
+            'style': "light",
+            'center': { 'lon': workplace[1], 'lat': workplace[0]},
+            'zoom': MAP_ZOOM, 'layers': create_plotly_isochrones(polys, [f'rgb{rgb}' for rgb in zone_rgb[::-1]], 0.1, rings) # enter colors from largest to smallest isochrone
+        },
+        margin = {'l':0, 'r':0, 'b':0, 't':0})
+
+    return fig
+
+
+class TopKPerGroup:
+    # Streaming k smallest values per group. Each update keeps only rows that beat their group's current k-th value, so
+    # after the first chunk almost nothing survives the filter and the input is never sorted or copied as a whole.
+    # Ties go to the row seen first, matching a stable sort.
+
+    def __init__(self, k):
+        self.k = k
+        self.groups = np.empty(0, dtype='int64')
+        self.values = np.empty(0)
+        self.ids = np.empty(0, dtype='int64')
+        self.thresholds = np.empty(0) # k-th smallest value per group so far, inf while a group has fewer than k rows
+
+    def update(self, groups, values, ids): # ids must increase across updates (e.g. row positions)
+        groups = np.asarray(groups, dtype='int64')
+        if len(groups) and groups.max() >= len(self.thresholds):
+            self.thresholds = np.concatenate([self.thresholds, np.full(groups.max() + 1 - len(self.thresholds), np.inf)])
+        keep = values < self.thresholds[groups]
+        groups = np.concatenate([self.groups, groups[keep]])
+        values = np.concatenate([self.values, np.asarray(values)[keep]])
+        ids = np.concatenate([self.ids, np.asarray(ids)[keep]])
+
+        order = np.lexsort((ids, values, groups))
+        groups, values, ids = groups[order], values[order], ids[order]
+        starts = np.r_[0, np.flatnonzero(groups[1:] != groups[:-1]) + 1]
+        rank = np.arange(len(groups)) - np.repeat(starts, np.diff(np.r_[starts, len(groups)]))
+        best = rank < self.k
+        self.groups, self.values, self.ids = groups[best], values[best], ids[best]
+        full = rank == self.k - 1
+        self.thresholds[groups[full]] = values[full]
+
+    def result(self): # (group, value, id) arrays of the winners, ordered by value then id
+        order = np.lexsort((self.ids, self.values))
+        return self.groups[order], self.values[order], self.ids[order]
+
+
+def top_k_per_group(groups, values, k, chunk_size=65536): # positions of the k smallest values in each group, ordered by value
+    top = TopKPerGroup(k)
+    for start in range(0, len(values), chunk_size):
+        top.update(groups[start:start + chunk_size], values[start:start + chunk_size], np.arange(start, min(start + chunk_size, len(values))))
+    return top.result()[2]
+
+
+# Results table columns, with rents next to one another, and the listing columns they come from
+TABLE_COLUMNS = {'rent': 'rent', 'effective rent': 'adjusted_rent', 'lat': 'lat', 'long': 'long', 'random_real': 'random_real', 'type': 'type',
+                 'commute time (minutes)': 'commute time (minutes)', 'est. commute (minutes)': 'commute_min'}
+
+
+def cheapest_per_zone(results, k=3): # the k lowest effective rents in each commute zone, ready for st.table
+    top = results.iloc[top_k_per_group(results['zone'].to_numpy(), results['adjusted_rent'].to_numpy(), k)]
+    return pd.DataFrame({name: top[column].array for name, column in TABLE_COLUMNS.items()})
+
+
+def build_legend(contours, zone_rgb, opacity=0.15): # table of commute-time labels on each zone's fill color
+    # One legend row per zone, smallest first, plus grey for listings outside every isochrone
+    df = pd.DataFrame({'time': zone_labels(contours), 'rgb': zone_rgb + [(240, 240, 240)]})
+    df['rgba'] = [f'rgba({r},{g},{b},{opacity})' for r, g, b in df.rgb]
+
+    color_fig = go.Figure(data=[go.Table(
+    header=dict(
+        values=["Commute times (minutes)"],
+        line_color='black', fill_color='white',
+        align='center', font=dict(color='black', size=14)
+    ),
+    cells=dict(
+        values=[df.time],
+        line_color=['black'], fill_color=[df.rgba],
+        align='center', font=dict(color='black', size=11)
+    ))
+    ])
+    color_fig.update_layout(width=400, height=40 + 40 * len(df), margin=dict(t=0, b=0, pad=0))
+    return color_fig
+
+
+def search_workplace(address, mode, contours, hourly_income, rental_range, apt_types, mapbox_access_token, get_map_data, k=3): # the isochrone app's submit path without the UI: cheapest_per_zone of the matching listings, None if the address can't be geocoded
+    center = get_geocoords(address, mapbox_access_token)
+    if center is None:
+        return None
+    workplace = center[::-1]
+    hub = find_hub(workplace, mode, contours)
+    polys = hub.polys if hub is not None else get_isochrones(workplace, mode, contours, mapbox_access_token)
+    results = get_map_data(rental_range, apt_types, bbox=polys[-1].bounds)
+    if not len(results):
+        return results
+    # A household of one, priced by the same code as the app's 'priced' stage
+    return cheapest_per_zone(price_household(results, [{'workplace': workplace, 'polys': polys, 'hub': hub, 'hourly_income': hourly_income}], contours), k)
+
+
+@functools.lru_cache(maxsize=32)
+def cached_legend(contours, zone_rgb, opacity=0.15): # build_legend once per process for each tuple of contours and colors; st.plotly_chart only serializes it
+    return build_legend(list(contours), list(zone_rgb), opacity)
+
+
+# The isochrone app's submit path as a memoized stage graph. Geocoding, isochrones, loading and classification depend only
+# on the addresses, modes and contours; the rent range, apartment types and wages only feed the cheap final 'priced' stage.
+search_graph = StageGraph(max_entries=16, ttl=600) # listings change with ingest and store rebuilds, so no stage is served for longer than 10 minutes
+
+
+@search_graph.add('workplaces', ['addresses'], context=['mapbox_access_token'])
+def _workplaces(addresses, mapbox_access_token): # (lat, long) per commuter, None for an address Mapbox can't find
+    return [center and center[::-1] for center in get_geocoords_many(list(addresses), mapbox_access_token)]
+
+
+@search_graph.add('hubs', ['workplaces', 'modes', 'contours'])
+def _hubs(workplaces, modes, contours): # the precomputed hub (hubs.py) each workplace snaps to, None where there isn't one
+    return [find_hub(w, m, contours) for w, m in zip(workplaces, modes)]
+
+
+@search_graph.add('isochrones', ['workplaces', 'modes', 'contours', 'hubs'], context=['mapbox_access_token'])
+def _isochrones(workplaces, modes, contours, hubs, mapbox_access_token): # one list of polygons per commuter, smallest to largest; hubs already have theirs
+    todo = [i for i, hub in enumerate(hubs) if hub is None]
+    fetched = iter(get_isochrones_many([workplaces[i] for i in todo], [modes[i] for i in todo], list(contours), mapbox_access_token) if todo else [])
+    return [hub.polys if hub is not None else next(fetched) for hub in hubs]
+
+
+@search_graph.add('area_listings', ['isochrones'], context=['get_map_data'], max_entries=4) # whole bounding boxes of listings: keep only a few
+def _area_listings(isochrones, get_map_data): # every listing inside the bounding box of the outermost isochrones, before the rent and type filters
+    bounds = np.array([polys[-1].bounds for polys in isochrones])
+    return get_map_data(None, None, bbox=(*bounds[:, :2].min(axis=0), *bounds[:, 2:].max(axis=0)))
+
+
+@search_graph.add('commute_matrix', ['area_listings', 'isochrones', 'workplaces', 'hubs', 'contours'], max_entries=4, rows=lambda matrix: matrix[0].shape[1])
+def _commute_matrix(area_listings, isochrones, workplaces, hubs, contours):
+    return household_commute_matrix(area_listings, [{'workplace': w, 'polys': p, 'hub': h} for w, p, h in zip(workplaces, isochrones, hubs)], list(contours))
+
+
+@search_graph.add('priced', ['area_listings', 'commute_matrix', 'wages', 'rental_range', 'apt_types', 'contours'], max_entries=8)
+def _priced(area_listings, commute_matrix, wages, rental_range, apt_types, contours): # the filtered listings with zones, commute estimates and adjusted rents
+    mask = area_listings['rent'].between(*rental_range).to_numpy() & area_listings['type'].isin(apt_types).to_numpy()
+    zones, minutes = commute_matrix
+    return apply_commute_costs(area_listings[mask].reset_index(drop=True), zones[:, mask], minutes[:, mask], wages, list(contours))
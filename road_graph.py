@@ -0,0 +1,215 @@
+"""
+Offline isochrones from a local road network, for when the Mapbox isochrone API is slow, out of quota or unreachable.
+
+A road graph is a .npz of node coordinates plus compressed sparse row (CSR) adjacency: indptr/indices list each node's
+outgoing edges, with edge lengths in meters and driving speeds in km/h. `build` converts an edge list exported from an
+OSM extract (one row per road segment: u_lat, u_long, v_lat, v_long and optional length_m, speed_kmh, oneway) into that
+format. An isochrone set is one Dijkstra from the workplace's nearest node, stopped at the longest contour. Each contour
+covers the reached nodes plus however far one could still get off the network in the time left, rasterized at CELL_M,
+and its outer ring is returned in the same form as the Mapbox backend's.
+
+    python road_graph.py build dc_edges.csv --out road_graph.npz
+    python road_graph.py grid --out road_graph.npz      # synthetic street grid around Arlington, VA for offline testing
+    ISOCHRONE_BACKEND=graph streamlit run apartments_streamlit_isochrone.py
+"""
+
+import argparse, heapq, os, threading
+
+import numpy as np
+import pandas as pd
+import shapely
+
+
+ROAD_GRAPH_PATH = 'road_graph.npz'
+MODE_SPEEDS_KMH = {'cycling': 16, 'walking': 5} # driving uses each edge's own speed
+ACCESS_SPEEDS_KMH = {'driving': 20, 'cycling': 16, 'walking': 5} # getting between the network and a point off it
+MAX_ACCESS_M = 400 # how far a contour reaches beyond its last reached node
+CELL_M = 100 # raster resolution of the contours
+M_PER_DEGREE_LAT = 110_574
+
+
+def local_meters(lat, long, origin): # equirectangular projection around origin = (lat, long); accurate to well under 1% across a metro area
+    return (np.asarray(long) - origin[1]) * M_PER_DEGREE_LAT * np.cos(np.radians(origin[0])), (np.asarray(lat) - origin[0]) * M_PER_DEGREE_LAT
+
+
+class RoadGraph:
+    # Directed road network in CSR form: the edges leaving node i are indices[indptr[i]:indptr[i + 1]]
+
+    def __init__(self, lat, long, indptr, indices, length, speed):
+        self.lat, self.long = np.asarray(lat, dtype='float64'), np.asarray(long, dtype='float64')
+        self.indptr = np.asarray(indptr, dtype='int64')
+        self.indices = np.asarray(indices, dtype='int32')
+        self.length = np.asarray(length, dtype='float32') # meters
+        self.speed = np.asarray(speed, dtype='float32') # km/h when driving
+        self._edge_seconds = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.lat)
+
+    @classmethod
+    def from_edges(cls, lat, long, src, dst, length=None, speed=None, oneway=None): # nodes plus an edge list; edges are two-way unless oneway is set
+        src, dst = np.asarray(src, dtype='int64'), np.asarray(dst, dtype='int64')
+        if length is None:
+            x, y = local_meters(lat, long, (float(np.mean(lat)), float(np.mean(long))))
+            length = np.hypot(x[src] - x[dst], y[src] - y[dst])
+        length = np.asarray(length, dtype='float32')
+        speed = np.full(len(src), 40, dtype='float32') if speed is None else np.asarray(speed, dtype='float32')
+        twoway = np.ones(len(src), dtype=bool) if oneway is None else ~np.asarray(oneway, dtype=bool)
+        src, dst = np.concatenate([src, dst[twoway]]), np.concatenate([dst, src[twoway]])
+        length, speed = np.concatenate([length, length[twoway]]), np.concatenate([speed, speed[twoway]])
+
+        order = np.argsort(src, kind='stable')
+        indptr = np.concatenate([[0], np.cumsum(np.bincount(src, minlength=len(lat)))])
+        return cls(lat, long, indptr, dst[order], length[order], speed[order])
+
+    @classmethod
+    def load(cls, path=ROAD_GRAPH_PATH):
+        with np.load(path) as data:
+            return cls(*(data[name] for name in ['lat', 'long', 'indptr', 'indices', 'length', 'speed']))
+
+    def save(self, path=ROAD_GRAPH_PATH):
+        np.savez(path, lat=self.lat, long=self.long, indptr=self.indptr, indices=self.indices, length=self.length, speed=self.speed)
+
+    def edge_seconds(self, mode): # travel time of every edge for a mode, computed once per graph
+        with self._lock:
+            if mode not in self._edge_seconds:
+                kmh = self.speed if mode == 'driving' else np.float32(MODE_SPEEDS_KMH[mode])
+                self._edge_seconds[mode] = (self.length / (kmh / 3.6)).astype('float64')
+            return self._edge_seconds[mode]
+
+    def nearest_node(self, lat, long): # index of the node closest to (lat, long)
+        x, y = local_meters(self.lat, self.long, (lat, long))
+        return int(np.argmin(x * x + y * y))
+
+    def travel_seconds(self, origin, mode, limit): # Dijkstra from node origin; seconds to every node, inf beyond limit seconds
+        indptr, indices, cost = self.indptr, self.indices, self.edge_seconds(mode)
+        seconds = [np.inf] * len(self) # plain lists: per-element access from Python is much faster than on ndarrays
+        seconds[origin] = 0.0
+        done = [False] * len(self)
+        heap = [(0.0, origin)]
+        while heap:
+            t, node = heapq.heappop(heap)
+            if done[node]:
+                continue
+            done[node] = True
+            start, stop = indptr[node], indptr[node + 1]
+            for neighbor, c in zip(indices[start:stop].tolist(), cost[start:stop].tolist()):
+                arrival = t + c
+                if arrival <= limit and arrival < seconds[neighbor]:
+                    seconds[neighbor] = arrival
+                    heapq.heappush(heap, (arrival, neighbor))
+        return np.array(seconds)
+
+
+def contour_rings(graph, seconds, minutes, mode, origin): # outer ring of each contour as [[long, lat], ...], smallest to largest
+    access_mps = ACCESS_SPEEDS_KMH[mode] / 3.6
+    reached = np.flatnonzero(seconds <= max(minutes) * 60)
+    if not len(reached):
+        raise ValueError(f'workplace {origin} is outside the road graph: no road within {max(minutes)} minutes {mode}')
+    x, y = local_meters(graph.lat[reached], graph.long[reached], origin)
+    # Rasterize at CELL_M: a cell is inside a contour if some reached node can get to it off the network in the time left
+    k = int(np.ceil(MAX_ACCESS_M / CELL_M))
+    x0, y0 = x.min() - k * CELL_M, y.min() - k * CELL_M
+    ix, iy = ((x - x0) // CELL_M).astype('int64'), ((y - y0) // CELL_M).astype('int64')
+    shape = (iy.max() + k + 1, ix.max() + k + 1)
+    offsets = [(dy, dx, np.hypot(dy, dx) * CELL_M) for dy in range(-k, k + 1) for dx in range(-k, k + 1) if np.hypot(dy, dx) * CELL_M <= MAX_ACCESS_M]
+
+    rings, previous = [], None
+    for m in minutes:
+        reach = np.full((shape[0] + 2 * k, shape[1] + 2 * k), -1.0) # remaining off-network reach per cell, padded by k
+        within = seconds[reached] <= m * 60
+        np.maximum.at(reach, (iy[within] + k, ix[within] + k), np.minimum((m * 60 - seconds[reached][within]) * access_mps, MAX_ACCESS_M))
+        covered = np.zeros(shape, dtype=bool)
+        for dy, dx, distance in offsets:
+            covered |= reach[k + dy:k + dy + shape[0], k + dx:k + dx + shape[1]] >= distance
+
+        # One rectangle per horizontal run of covered cells, unioned into the contour
+        edges = np.diff(np.pad(covered, ((0, 0), (1, 1))).astype('int8'), axis=1)
+        rows, starts = np.nonzero(edges == 1)
+        stops = np.nonzero(edges == -1)[1]
+        area = shapely.union_all(shapely.box(x0 + starts * CELL_M, y0 + rows * CELL_M, x0 + stops * CELL_M, y0 + (rows + 1) * CELL_M))
+        # Plus wherever the workplace (at 0, 0) reaches on foot; for short contours from a workplace far off the network that's all there is
+        area = area.union(shapely.Point(0, 0).buffer(max(min(m * 60 * access_mps, MAX_ACCESS_M), CELL_M / 2)))
+        if area.geom_type == 'MultiPolygon': # keep the piece around the workplace, like Mapbox's contours
+            area = max(area.geoms, key=lambda p: p.area)
+        area = shapely.Polygon(area.exterior).simplify(CELL_M / 2) # smooth the raster's stair steps
+        if previous is not None: # simplifying can shave a little off; contours must stay nested for zone classification
+            area = shapely.Polygon(area.union(previous).exterior)
+        previous = area
+        ring = np.asarray(area.exterior.coords)
+        lat = origin[0] + ring[:, 1] / M_PER_DEGREE_LAT
+        long = origin[1] + ring[:, 0] / (M_PER_DEGREE_LAT * np.cos(np.radians(origin[0])))
+        rings.append(np.round(np.column_stack([long, lat]), 6).tolist())
+    return rings
+
+
+def isochrone_rings(graph, workplace, mode, minutes): # same result as isochrones.fetch_isochrone_rings, computed from the graph
+    minutes = sorted(minutes)
+    origin = graph.nearest_node(*workplace)
+    x, y = local_meters(graph.lat[origin], graph.long[origin], workplace)
+    access = float(np.hypot(x, y)) / (ACCESS_SPEEDS_KMH[mode] / 3.6) # from the workplace to the network
+    seconds = graph.travel_seconds(origin, mode, max(minutes) * 60 - access) + access
+    return contour_rings(graph, seconds, minutes, mode, tuple(workplace))
+
+
+def grid_graph(center=(38.8816, -77.1166), size=81, spacing_m=200, speed_kmh=40, arterial_every=10, arterial_kmh=70): # synthetic street grid with faster arterials, for running offline
+    rows, cols = np.divmod(np.arange(size * size), size)
+    lat = center[0] + (rows - size // 2) * spacing_m / M_PER_DEGREE_LAT
+    long = center[1] + (cols - size // 2) * spacing_m / (M_PER_DEGREE_LAT * np.cos(np.radians(center[0])))
+    node = np.arange(size * size).reshape(size, size)
+    src = np.concatenate([node[:, :-1].ravel(), node[:-1, :].ravel()])
+    dst = np.concatenate([node[:, 1:].ravel(), node[1:, :].ravel()])
+    arterial = np.concatenate([np.repeat(np.arange(size) % arterial_every == 0, size - 1), np.tile(np.arange(size) % arterial_every == 0, size - 1)])
+    return RoadGraph.from_edges(lat, long, src, dst, speed=np.where(arterial, arterial_kmh, speed_kmh))
+
+
+def read_edge_list(path): # RoadGraph from a CSV edge list; endpoints that share coordinates (to 1e-6 degrees) become one node
+    edges = pd.read_csv(path)
+    ends = np.concatenate([edges[['u_lat', 'u_long']].to_numpy(), edges[['v_lat', 'v_long']].to_numpy()]).round(6)
+    nodes, node_ids = np.unique(ends, axis=0, return_inverse=True)
+    node_ids = node_ids.ravel()
+    return RoadGraph.from_edges(nodes[:, 0], nodes[:, 1], node_ids[:len(edges)], node_ids[len(edges):],
+                                edges['length_m'] if 'length_m' in edges else None,
+                                edges['speed_kmh'] if 'speed_kmh' in edges else None,
+                                edges['oneway'].astype(bool) if 'oneway' in edges else None)
+
+
+def graph_version(path=ROAD_GRAPH_PATH): # changes whenever the graph file is rebuilt; None while there is none
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+_graphs = {} # path -> (version, RoadGraph)
+_graphs_lock = threading.Lock()
+
+
+def open_graph(path=ROAD_GRAPH_PATH): # one RoadGraph per path per process, shared by every session and reloaded after a rebuild
+    version = graph_version(path)
+    with _graphs_lock:
+        if path not in _graphs or _graphs[path][0] != version:
+            _graphs[path] = (version, RoadGraph.load(path))
+        return _graphs[path][1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build a road graph for offline isochrones.')
+    parser.add_argument('command', choices=['build', 'grid'])
+    parser.add_argument('edges', nargs='?', help='CSV edge list (build only)')
+    parser.add_argument('--out', default=ROAD_GRAPH_PATH)
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        if not args.edges:
+            parser.error('build needs an edge list CSV')
+        graph = read_edge_list(args.edges)
+    else:
+        graph = grid_graph()
+    graph.save(args.out)
+    print(f'wrote {len(graph)} nodes and {len(graph.indices)} edges to {args.out}')
+
+
+if __name__ == '__main__':
+    main()
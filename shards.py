@@ -0,0 +1,150 @@
+"""
+Region-sharded listing store: one listing_store directory per grid cell plus a manifest of shard bounding boxes.
+
+Listings are partitioned into cells of --cell-degrees latitude/longitude (1 degree is roughly 69 x 54 miles around DC).
+A query reads the manifest, opens only the shards whose bounding box intersects the search area and keeps the most
+recently used shards open in an LRU, so memory and load time follow the size of the search area rather than the size
+of the whole dataset. Shards can be rebuilt one at a time; the manifest records when each was built, and open stores
+of a rebuilt shard are replaced on their next use.
+
+    python shards.py build                        # address_data_sql.db -> listing_shards/
+    python shards.py build --only n38_w078        # rebuild one shard
+    LISTING_BACKEND=shards streamlit run apartments_streamlit_isochrone.py
+"""
+
+import argparse, functools, json, os, shutil, threading, time
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from listing_store import CATEGORICAL, DTYPES, ListingStore, build_store
+
+
+SHARDS_PATH = 'listing_shards'
+CELL_DEGREES = 1.0
+
+
+def shard_name(row, col): # e.g. 'n38_w078' for the cell whose south-west corner is 38N 78W at 1 degree cells
+    return f"{'s' if row < 0 else 'n'}{abs(row):02d}_{'w' if col < 0 else 'e'}{abs(col):03d}"
+
+
+def read_manifest(path=SHARDS_PATH):
+    manifest_path = os.path.join(path, 'manifest.json')
+    if not os.path.exists(manifest_path):
+        return {'cell_degrees': CELL_DEGREES, 'shards': {}}
+    with open(manifest_path) as f:
+        return json.load(f)
+
+
+def write_manifest(manifest, path=SHARDS_PATH): # atomic, so readers never see a partial manifest
+    tmp = os.path.join(path, 'manifest.json.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp, os.path.join(path, 'manifest.json'))
+
+
+def build_shards(df, path=SHARDS_PATH, cell_degrees=CELL_DEGREES, only=None): # writes one listing store per cell; only = shard names to rebuild, leaving the others untouched
+    df = df.dropna(subset=['lat', 'long'])
+    manifest = read_manifest(path)
+    if manifest['shards'] and manifest['cell_degrees'] != cell_degrees:
+        raise ValueError(f"{path} is sharded at {manifest['cell_degrees']} degrees; rebuild it from scratch to change the cell size")
+    manifest['cell_degrees'] = cell_degrees
+    os.makedirs(path, exist_ok=True)
+
+    cells = [np.floor(df[column].to_numpy() / cell_degrees).astype('int64') for column in ['lat', 'long']]
+    gone = []
+    if only is None: # a full rebuild: cells whose listings have all gone get no shard
+        present = {shard_name(row, col) for row, col in set(zip(*cells))}
+        gone = [name for name in manifest['shards'] if name not in present]
+        for name in gone:
+            del manifest['shards'][name]
+    for (row, col), shard in df.groupby(cells, sort=True):
+        name = shard_name(row, col)
+        if only is not None and name not in only:
+            continue
+        build_store(shard, os.path.join(path, name)) # swaps the new shard in, so queries never open a half-written one
+
+        manifest['shards'][name] = {'rows': len(shard), 'built_at': time.time(),
+                                    'bounds': [float(shard['long'].min()), float(shard['lat'].min()), float(shard['long'].max()), float(shard['lat'].max())]}
+    write_manifest(manifest, path)
+    for name in gone: # only once the manifest no longer sends queries to them
+        shutil.rmtree(os.path.join(path, name), ignore_errors=True)
+    return manifest
+
+
+class ShardedStore:
+    # Opens shards on demand and keeps up to max_open of them in an LRU
+
+    def __init__(self, path=SHARDS_PATH, max_open=16):
+        self.path = path
+        self.max_open = max_open
+        self._open = OrderedDict() # (name, built_at) -> ListingStore
+        self._lock = threading.Lock()
+        self._manifest_mtime = None
+        self.manifest = None
+
+    def _refresh_manifest(self): # rereads the manifest after a rebuild; call with self._lock held
+        mtime = os.stat(os.path.join(self.path, 'manifest.json')).st_mtime_ns
+        if mtime != self._manifest_mtime:
+            self.manifest = read_manifest(self.path)
+            self._manifest_mtime = mtime
+
+    def shards_for(self, bbox=None): # names of the shards whose bounds intersect bbox = (min_long, min_lat, max_long, max_lat)
+        with self._lock:
+            self._refresh_manifest()
+            shards = self.manifest['shards']
+        if bbox is None:
+            return sorted(shards)
+        return sorted(name for name, shard in shards.items()
+                      if shard['bounds'][0] <= bbox[2] and shard['bounds'][2] >= bbox[0] and shard['bounds'][1] <= bbox[3] and shard['bounds'][3] >= bbox[1])
+
+    def shard(self, name): # the open ListingStore for a shard, opening it (and evicting the least recently used) if needed
+        with self._lock:
+            key = (name, self.manifest['shards'][name]['built_at'])
+            if key not in self._open:
+                for stale in [k for k in self._open if k[0] == name]: # an older build of the same shard
+                    del self._open[stale]
+                self._open[key] = ListingStore(os.path.join(self.path, name))
+                while len(self._open) > self.max_open:
+                    self._open.popitem(last=False)
+            self._open.move_to_end(key)
+            return self._open[key]
+
+    def query(self, rental_range, apt_types, bbox=None, columns=None): # same filters as ListingStore.query, over every shard intersecting bbox
+        frames = [self.shard(name).query(rental_range, apt_types, bbox, columns) for name in self.shards_for(bbox)]
+        if not frames:
+            return pd.DataFrame({name: pd.Series(dtype='category' if name in CATEGORICAL else DTYPES[name]) for name in columns or list(DTYPES)})
+        df = pd.concat(frames, ignore_index=True) if len(frames) > 1 else frames[0]
+        for name in CATEGORICAL: # shards have their own category lists, which concat turns into plain objects
+            if name in df and df[name].dtype != 'category':
+                df[name] = df[name].astype('category')
+        return df
+
+
+@functools.lru_cache(maxsize=None)
+def open_shards(path=SHARDS_PATH): # one ShardedStore per path per process; it rereads the manifest itself after a rebuild
+    return ShardedStore(path)
+
+
+def get_map_data(rental_range, apt_types, bbox=None, path=SHARDS_PATH): # drop-in for listings_db.get_map_data
+    return open_shards(path).query(rental_range, apt_types, bbox)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build region shards of address_data_sql as memory-mapped listing stores.')
+    parser.add_argument('command', choices=['build'])
+    parser.add_argument('--db', default='address_data_sql.db')
+    parser.add_argument('--out', default=SHARDS_PATH)
+    parser.add_argument('--cell-degrees', type=float, default=CELL_DEGREES)
+    parser.add_argument('--only', nargs='+', help='shard names to rebuild, e.g. n38_w078')
+    args = parser.parse_args()
+
+    from listings_db import TABLE, get_engine
+    df = pd.read_sql(f'SELECT lat, long, rent, type, random_real FROM {TABLE}', get_engine(args.db))
+    manifest = build_shards(df, args.out, args.cell_degrees, set(args.only) if args.only else None)
+    print(f"{len(manifest['shards'])} shards, {sum(s['rows'] for s in manifest['shards'].values())} listings in {args.out}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+import hashlib, time
+
+from cache import TieredCache
+from metrics import stage
+
+
+class StageGraph:
+    # Named stages that each depend on some request parameters and/or upstream stages. A stage's output is memoized under
+    # a key built only from the inputs it declares (upstream stages contribute their own keys), so changing a parameter
+    # recomputes just the stages downstream of it. Each stage has its own small in-memory LRU shared across sessions, so
+    # stages with large outputs (a bounding box of listings, an N x M commute matrix) can keep fewer of them, and each
+    # session also keeps its latest output per stage so its own reruns survive eviction from the shared cache. Outputs
+    # expire after ttl seconds, which bounds how long a search can keep serving listings from before an ingest or rebuild.
+    # Stage outputs are shared objects: stages must copy, not modify, the values they receive.
+
+    def __init__(self, max_entries=16, ttl=600, name='stages'):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.name = name
+        self.stages = {} # name -> (fn, inputs, context, rows)
+        self.caches = {} # name -> TieredCache
+
+    def add(self, name, inputs, context=(), max_entries=None, rows=len): # decorator; fn is called with the declared inputs, plus context params that don't affect the result (e.g. the access token). rows(output) is the row count recorded for the stage
+        def register(fn):
+            self.stages[name] = (fn, tuple(inputs), tuple(context), rows)
+            self.caches[name] = TieredCache(None, ttl=self.ttl, max_memory=max_entries or self.max_entries, name=f'{self.name}:{name}')
+            return fn
+        return register
+
+    def key(self, name, params): # depends only on params, so a cached stage's upstream never has to run
+        parts = [f'{i}={self.key(i, params) if i in self.stages else repr(params[i])}' for i in self.stages[name][1]]
+        return f'{name}:' + hashlib.sha1('|'.join(parts).encode()).hexdigest()
+
+    def rows(self, name, value):
+        return None if value is None else self.stages[name][3](value)
+
+    def run(self, target, params, session=None, values=None): # value of the target stage; session is a per-user dict (e.g. st.session_state) for its latest outputs
+        # values holds the stages already resolved for this request: pass the same dict to several runs over the same
+        # params so each stage is resolved, and recorded, once
+        session = session if session is not None else {}
+        values = values if values is not None else {}
+
+        def resolve(name):
+            if name in values:
+                return values[name]
+            fn, inputs, context, _ = self.stages[name]
+            key = self.key(name, params)
+            entry = session.get(name)
+            computed = []
+            if entry is not None and entry[0] == key and time.time() - entry[2] < self.ttl:
+                value = entry[1]
+            else:
+                def compute():
+                    args = {i: resolve(i) if i in self.stages else params[i] for i in inputs}
+                    upstream = [i for i in inputs if i in self.stages]
+                    computed.append(name)
+                    with stage(name, rows_in=self.rows(upstream[0], args[upstream[0]]) if upstream else None) as s:
+                        result = fn(**args, **{c: params[c] for c in context})
+                        s.rows_out = self.rows(name, result)
+                        return result
+
+                value = self.caches[name].get(key, compute)
+                fetched_at = self.caches[name].fetched_at(key) # the session copy expires with the shared entry, not ttl after this run
+                if value is not None and fetched_at is not None:
+                    session[name] = (key, value, fetched_at)
+            if not computed: # this session's last output, or served by another session's run
+                with stage(f'{name} (cached)') as s:
+                    s.rows_out = self.rows(name, value)
+            values[name] = value
+            return value
+
+        return resolve(target)
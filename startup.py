@@ -0,0 +1,85 @@
+"""
+Cold-start helpers for the Streamlit apps, and a check of how long an app takes to render its first page.
+
+Streamlit reruns the app script on every interaction, but modules, the Mapbox token and other static assets only need
+loading once per server process. The apps import the heavy pipeline modules only when a search is submitted, and
+warm_up() imports them on a background thread as soon as the form is on screen, so neither the first page nor (usually)
+the first search waits for them.
+
+    python startup.py apartments_streamlit_isochrone.py --budget 1.0
+
+runs the app's first render in a fresh interpreter, as on a cold container, and exits 1 if it takes longer than the
+budget or pulls in any of HEAVY_MODULES.
+"""
+
+import argparse, functools, importlib, json, subprocess, sys, threading
+
+
+HEAVY_MODULES = ['plotly', 'shapely', 'sqlalchemy', 'chart_studio', 'requests', 'haversine']
+
+# Runs in the fresh interpreter: streamlit itself is imported before the clock starts, since every page pays for it
+MEASURE = '''
+import json, sys, time
+from streamlit.testing.v1 import AppTest
+before = set(sys.modules)
+at = AppTest.from_file(sys.argv[1], default_timeout=120)
+start = time.perf_counter()
+at.run()
+seconds = time.perf_counter() - start
+print(json.dumps({'seconds': seconds, 'exceptions': [e.value for e in at.exception],
+                  'imported': sorted({m.split('.')[0] for m in set(sys.modules) - before})}))
+'''
+
+
+@functools.lru_cache(maxsize=None)
+def read_text(path): # file contents with trailing whitespace removed, read once per process (e.g. mapbox_key.txt)
+    with open(path) as f:
+        return f.read().rstrip()
+
+
+@functools.lru_cache(maxsize=None)
+def read_bytes(path): # e.g. images for st.image, read once per process
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+_warmed = set()
+_warm_lock = threading.Lock()
+
+
+def warm_up(modules): # imports modules on a background thread, once per process
+    with _warm_lock:
+        modules = [m for m in modules if m not in _warmed]
+        _warmed.update(modules)
+    if modules:
+        threading.Thread(target=lambda: [importlib.import_module(m) for m in modules], name='warm-up', daemon=True).start()
+
+
+def measure_first_render(app): # {'seconds', 'exceptions', 'imported'} for the app's first page in a fresh interpreter
+    out = subprocess.run([sys.executable, '-c', MEASURE, app], capture_output=True, text=True, check=True).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check an app's cold first-render time and imports against a budget.")
+    parser.add_argument('apps', nargs='+')
+    parser.add_argument('--budget', type=float, default=1.0, help='seconds allowed for the first render, not counting streamlit itself')
+    args = parser.parse_args()
+
+    failed = False
+    for app in args.apps:
+        result = measure_first_render(app)
+        heavy = sorted(set(result['imported']) & set(HEAVY_MODULES))
+        over = result['seconds'] > args.budget
+        failed |= over or bool(heavy) or bool(result['exceptions'])
+        print(f"{app}: first render {result['seconds']:.3f}s (budget {args.budget}s)" + (' OVER BUDGET' if over else ''))
+        if heavy:
+            print(f'  imports heavy modules before the first submit: {", ".join(heavy)}')
+        for exception in result['exceptions']:
+            print(f'  exception: {exception}')
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+import numpy as np
+import shapely
+
+
+def classify_nested_zones(lat, long, polygons): # index of the smallest nested isochrone (ordered smallest to largest) containing each point, len(polygons) if none; binary searches the polygon stack, so O(log k) containment tests per point instead of k
+    lat = np.asarray(lat, dtype='float64')
+    long = np.asarray(long, dtype='float64')
+    # Invariant: the answer for each point lies in [lo, hi], where hi == len(polygons) means outside every polygon.
+    # Nested polygons have nested bounding boxes, so the boxes that miss a point are a prefix of the stack and lo can start past them
+    lo = np.zeros(lat.shape, dtype='int64')
+    for polygon in polygons:
+        shapely.prepare(polygon)
+        min_long, min_lat, max_long, max_lat = polygon.bounds
+        lo += (long < min_long) | (long > max_long) | (lat < min_lat) | (lat > max_lat)
+    hi = np.full(lat.shape, len(polygons), dtype='int64')
+
+    active = np.flatnonzero(lo < hi)
+    while len(active):
+        mid = (lo[active] + hi[active]) // 2
+        inside = np.empty(len(active), dtype=bool)
+        order = np.argsort(mid, kind='stable') # group points by the polygon they probe, so each polygon gets one vectorized test per round
+        probed, starts = np.unique(mid[order], return_index=True)
+        for m, sel in zip(probed, np.split(order, starts[1:])):
+            idx = active[sel]
+            inside[sel] = shapely.contains_xy(polygons[m], long[idx], lat[idx])
+        hi[active[inside]] = mid[inside]
+        lo[active[~inside]] = mid[~inside] + 1
+        active = active[lo[active] < hi[active]]
+
+    return lo
+
+
+def interpolate_commute_minutes(lat, long, zones, polygons, minutes, workplace): # continuous commute estimate from each point's position between its inner and outer contour
+    lat = np.asarray(lat, dtype='float64')
+    long = np.asarray(long, dtype='float64')
+    zones = np.asarray(zones)
+    minutes = np.asarray(minutes, dtype='float64')
+    commute = np.empty(lat.shape, dtype='float64')
+
+    # Beyond the largest contour there's nothing to interpolate against, so charge one more contour step, like the old '>40' bucket
+    outside = zones == len(polygons)
+    commute[outside] = minutes[-1] + (minutes[-1] - minutes[-2] if len(minutes) > 1 else minutes[-1])
+
+    for i, polygon in enumerate(polygons):
+        idx = np.flatnonzero(zones == i)
+        if not len(idx):
+            continue
+        points = shapely.points(long[idx], lat[idx])
+        inner_time = minutes[i - 1] if i else 0.0
+        # The innermost zone interpolates from the workplace itself (0 minutes) out to the first contour
+        inner = polygons[i - 1].exterior if i else shapely.Point(workplace[1], workplace[0])
+        d_inner = shapely.distance(points, inner)
+        d_outer = shapely.distance(points, polygon.exterior)
+        total = d_inner + d_outer
+        frac = np.divide(d_inner, total, out=np.zeros_like(total), where=total > 0)
+        commute[idx] = inner_time + frac * (minutes[i] - inner_time)
+
+    return commute
+
+
+def zone_labels(minutes): # [10, 20, 30, 40] -> ['<10', '10-20', '20-30', '30-40', '>40'], one label per zone including the outside one
+    minutes = list(minutes)
+    return [f'<{minutes[0]}'] + [f'{a}-{b}' for a, b in zip(minutes, minutes[1:])] + [f'>{minutes[-1]}']